@@ -55,12 +55,11 @@ def send_mail(subject, message, from_email, recipient_list, priority="medium",
 
 def send_html_mail(subject, message, message_html, from_email, recipient_list,
                    priority="medium", fail_silently=False, auth_user=None,
-                   auth_password=None, connection_kwargs=None):
+                   auth_password=None, connection_kwargs=None, attachments=None):
     """
-    Function to queue HTML e-mails
+    Function to queue HTML e-mails. attachments are as for make_message().
     """
     from django.utils.encoding import force_unicode
-    from django.core.mail import EmailMultiAlternatives
     from mailer.models import make_message
     
     priority = PRIORITY_MAPPING[priority]
@@ -75,27 +74,48 @@ def send_html_mail(subject, message, message_html, from_email, recipient_list,
     subject = force_unicode(subject)
     message = force_unicode(message)
     
+    # built in one go: with MAILER_PRERENDER, msg.email is already rendered
+    # and cannot be added to
     msg = make_message(subject=subject,
                        body=message,
                        from_email=from_email,
                        to=recipient_list,
                        priority=priority,
-                       connection_kwargs=connection_kwargs)
-    email = msg.email
-    email = EmailMultiAlternatives(email.subject, email.body, email.from_email, email.to)
-    email.attach_alternative(message_html, "text/html")
-    msg.email = email
+                       connection_kwargs=connection_kwargs,
+                       attachments=attachments,
+                       alternatives=[(message_html, "text/html")])
     msg.save()
     return 1
 
 
 def send_mass_mail(datatuple, fail_silently=False, auth_user=None,
-                   auth_password=None, connection=None):
-    from mailer.models import make_message
-    num_sent = 0
-    for subject, message, sender, recipient in datatuple:
-        num_sent += send_mail(subject, message, sender, recipient)
-    return num_sent
+                   auth_password=None, connection=None, priority="medium"):
+    from django.utils.encoding import force_unicode
+    from django.core.mail import EmailMessage
+    
+    connection_kwargs = {}
+    if auth_user:
+        connection_kwargs["EMAIL_HOST_USER"] = auth_user
+    if auth_password:
+        connection_kwargs["EMAIL_HOST_PASSWORD"] = auth_password
+    
+    messages = [EmailMessage(force_unicode(subject), force_unicode(message), sender, recipient)
+                for subject, message, sender, recipient in datatuple]
+    return enqueue_many(messages, priority=priority, connection_kwargs=connection_kwargs)
+
+
+def enqueue_many(messages, priority="medium", connection_kwargs=None, chunk_size=None):
+    """
+    Queue many EmailMessages at once, with one INSERT per chunk_size messages
+    (MAILER_ENQUEUE_CHUNK_SIZE by default) in a single transaction. Returns
+    the number of messages queued.
+    """
+    from mailer.models import Message
+    
+    return Message.objects.enqueue_many(messages,
+                                        priority=PRIORITY_MAPPING[priority],
+                                        connection_kwargs=connection_kwargs,
+                                        chunk_size=chunk_size)
 
 
 def mail_admins(subject, message, fail_silently=False, connection=None, priority="medium"):
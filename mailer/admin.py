@@ -1,20 +1,55 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Q
 
-from mailer.models import Message, DontSendEntry, MessageLog
+from mailer.models import Message, DontSendEntry, MessageLog, Recipient
 from mailer.forms import MessageForm
 
 
+class RecipientChangeList(ChangeList):
+    """
+    Searches for words that look like an address in the Recipient table,
+    which covers To, Cc and Bcc, and for the rest in search_fields.
+    """
+    
+    def get_query_set(self, request):
+        query = self.query
+        addresses = [bit for bit in query.split() if "@" in bit]
+        self.query = " ".join(bit for bit in query.split() if "@" not in bit)
+        try:
+            qs = super(RecipientChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+        for address in addresses:
+            qs = qs.filter(Q(recipient_key__in=Recipient.objects.keys_for(address)) |
+                           Q(from_address__iexact=address))
+        return qs
+
+
 class MessageAdmin(admin.ModelAdmin):
     list_display = ["id", "to_addresses", "subject", "when_added", "priority"]
+    list_filter = ["priority", "when_added"]
+    # addresses are looked up by RecipientChangeList
+    search_fields = ["from_address", "subject"]
     form = MessageForm
+    
+    def get_changelist(self, request, **kwargs):
+        return RecipientChangeList
 
 
 class DontSendEntryAdmin(admin.ModelAdmin):
     list_display = ["to_address", "when_added"]
+    search_fields = ["normalized_address"]
 
 
 class MessageLogAdmin(admin.ModelAdmin):
     list_display = ["id", "to_addresses", "subject", "when_attempted", "result"]
+    list_filter = ["result", "when_attempted"]
+    # as on MessageAdmin
+    search_fields = ["from_address", "subject"]
+    
+    def get_changelist(self, request, **kwargs):
+        return RecipientChangeList
 
 
 admin.site.register(Message, MessageAdmin)
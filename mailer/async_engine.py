@@ -0,0 +1,420 @@
+"""
+An alternative delivery engine that speaks SMTP itself and keeps many
+sessions in flight on a single asyncore loop, instead of blocking one thread
+per connection.
+
+It works from the same queue, priority order and MessageLog bookkeeping as
+mailer.engine, but talks to the mail server directly rather than through
+MAILER_EMAIL_BACKEND. Messages that need TLS are handed to the regular
+backend.
+"""
+
+import re
+import sys
+import time
+import base64
+import socket
+import smtpd
+import smtplib
+import asyncore
+import asynchat
+import logging
+
+from django.conf import settings
+
+from mailer.engine import drain_queue, MessageSender, ResultBuffer
+from mailer.models import MissingAttachment
+from mailer.files import MissingFile, check_files, file_attachments, data_chunks
+
+
+# how many SMTP sessions to keep open at once.
+SESSIONS = getattr(settings, "MAILER_ASYNC_SESSIONS", 10)
+
+# how long (in seconds) a session may wait for the server before giving up.
+TIMEOUT = getattr(settings, "MAILER_ASYNC_TIMEOUT", 30)
+
+CRLF = "\r\n"
+
+
+def session_params(connection_kwargs):
+    """
+    Return the (host, port, username, password) a message with the given
+    connection_kwargs should be sent with, or None if it needs something this
+    engine does not support and should go through the regular backend.
+    """
+
+    kwargs = connection_kwargs or {}
+
+    def get(name, setting):
+        return kwargs.get(name, kwargs.get(setting, getattr(settings, setting)))
+
+    if get("use_tls", "EMAIL_USE_TLS"):
+        return None
+    return (get("host", "EMAIL_HOST"), int(get("port", "EMAIL_PORT")),
+            get("username", "EMAIL_HOST_USER") or None,
+            get("password", "EMAIL_HOST_PASSWORD") or None)
+
+
+class ChunkProducer(object):
+    """
+    An asynchat producer handing out the chunks of an iterable one by one.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def more(self):
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return ""
+
+
+class SMTPSession(asynchat.async_chat):
+    """
+    One SMTP connection, sending messages for as long as the dispatcher has
+    more of them for the same server and credentials.
+    """
+
+    def __init__(self, dispatcher, params, message):
+        asynchat.async_chat.__init__(self)
+        self.dispatcher = dispatcher
+        self.params = params
+        self.message = message
+        self.finished = False
+        self.state = "greeting"
+        # the ESMTP extensions the server announced, with their parameters
+        self.extensions = {}
+        self.reply_lines = []
+        self.buffer = []
+        self.last_activity = time.time()
+        self.set_terminator(CRLF)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(params[:2])
+        except socket.error:
+            self.close()
+            raise
+
+    def command(self, line, state):
+        self.state = state
+        self.last_activity = time.time()
+        self.push(line + CRLF)
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.buffer)
+        self.buffer = []
+        self.last_activity = time.time()
+        self.reply_lines.append(line[4:])
+        if line[3:4] == "-":
+            # multiline reply, wait for the rest of it
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        reply = "\n".join(self.reply_lines)
+        self.reply_lines = []
+        getattr(self, "reply_%s" % self.state)(code, reply)
+
+    # replies, by the state the session was in when it was sent
+
+    def reply_greeting(self, code, reply):
+        if code != 220:
+            return self.fail(smtplib.SMTPConnectError(code, reply))
+        self.command("EHLO %s" % socket.getfqdn(), "ehlo")
+
+    def reply_ehlo(self, code, reply):
+        if code != 250:
+            return self.command("HELO %s" % socket.getfqdn(), "helo")
+        # as smtplib.SMTP.ehlo() parses them; the first line greets
+        for line in reply.split("\n")[1:]:
+            match = re.match(r"(?P<feature>[A-Za-z0-9][A-Za-z0-9\-]*) ?", line)
+            if match:
+                feature = match.group("feature").lower()
+                params = line[match.end("feature"):].strip()
+                if feature == "auth":
+                    self.extensions[feature] = self.extensions.get(feature, "") + " " + params
+                else:
+                    self.extensions[feature] = params
+        self.login()
+
+    def reply_helo(self, code, reply):
+        if code != 250:
+            return self.fail(smtplib.SMTPHeloError(code, reply))
+        if self.params[2]:
+            return self.fail(smtplib.SMTPException("server does not support AUTH"))
+        self.next_message()
+
+    def reply_auth(self, code, reply):
+        if code != 235:
+            return self.fail(smtplib.SMTPAuthenticationError(code, reply))
+        self.next_message()
+
+    def reply_mail(self, code, reply):
+        if code != 250:
+            return self.reject(smtplib.SMTPSenderRefused(code, reply, self.envelope[0]))
+        self.refused = {}
+        self.pending_recipients = list(self.envelope[1])
+        self.next_recipient()
+
+    def reply_rcpt(self, code, reply):
+        if code not in (250, 251):
+            self.refused[self.recipient] = (code, reply)
+        self.next_recipient()
+
+    def reply_data(self, code, reply):
+        if code != 354:
+            return self.reject(smtplib.SMTPDataError(code, reply))
+        self.state = "sent"
+        data = self.envelope[2]
+        if not isinstance(data, str):
+            # an email.message.Message with file attachments, read from
+            # storage as the socket takes them
+            return self.push_with_producer(ChunkProducer(data_chunks(data)))
+        data = smtplib.quotedata(data)
+        if data[-2:] != CRLF:
+            data += CRLF
+        self.push(data + "." + CRLF)
+
+    def reply_sent(self, code, reply):
+        if code != 250:
+            return self.reject(smtplib.SMTPDataError(code, reply))
+        message, self.message = self.message, None
+        self.dispatcher.sent(message)
+        self.next_message()
+
+    def reply_rset(self, code, reply):
+        self.next_message()
+
+    def reply_quit(self, code, reply):
+        self.shutdown()
+
+    # transitions
+
+    def login(self):
+        username, password = self.params[2:]
+        if not username:
+            return self.next_message()
+        if "auth" not in self.extensions:
+            return self.fail(smtplib.SMTPException("server does not support AUTH"))
+        # "AUTH=PLAIN" is how some older servers announce it
+        mechanisms = self.extensions["auth"].replace("=", " ").upper().split()
+        if "PLAIN" not in mechanisms:
+            return self.fail(smtplib.SMTPException("server does not support AUTH PLAIN"))
+        token = base64.b64encode("\0%s\0%s" % (username, password))
+        self.command("AUTH PLAIN %s" % token, "auth")
+
+    def next_message(self):
+        if self.message is None:
+            self.message = self.dispatcher.next_message(self.params)
+        if self.message is None:
+            return self.command("QUIT", "quit")
+        try:
+            email = self.message.email
+            check_files(email)
+        except (MissingAttachment, MissingFile), err:
+            return self.reject(err)
+        if file_attachments(email):
+            data = email.message()
+        else:
+            data = email.message().as_string()
+            if isinstance(data, unicode):
+                data = data.encode("utf-8")
+        self.envelope = (email.from_email, email.recipients(), data)
+        logging.info("sending message '%s' to %s" % (self.message.subject.encode("utf-8"), self.message.to_addresses.encode("utf-8")))
+        self.command("MAIL FROM:%s" % smtplib.quoteaddr(self.envelope[0]), "mail")
+
+    def next_recipient(self):
+        if self.pending_recipients:
+            self.recipient = self.pending_recipients.pop(0)
+            return self.command("RCPT TO:%s" % smtplib.quoteaddr(self.recipient), "rcpt")
+        if len(self.refused) == len(self.envelope[1]):
+            return self.reject(smtplib.SMTPRecipientsRefused(self.refused))
+        self.command("DATA", "data")
+
+    def reject(self, err):
+        """
+        The server refused the current message; defer it and carry on with
+        the next one on the same connection.
+        """
+
+        message, self.message = self.message, None
+        self.dispatcher.deferred(message, err)
+        self.command("RSET", "rset")
+
+    def fail(self, err):
+        """
+        The connection itself failed; defer the current message and close.
+        """
+
+        if self.message is not None:
+            message, self.message = self.message, None
+            self.dispatcher.deferred(message, err)
+        self.shutdown()
+
+    def shutdown(self):
+        if not self.finished:
+            self.finished = True
+            self.close()
+            self.dispatcher.closed(self)
+
+    def check_timeout(self, now):
+        if now - self.last_activity > TIMEOUT:
+            self.fail(socket.timeout("timed out waiting for %s:%s" % self.params[:2]))
+
+    # asyncore hooks
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        if self.state == "quit":
+            self.shutdown()
+        else:
+            self.fail(smtplib.SMTPServerDisconnected("connection unexpectedly closed"))
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        # EnvironmentError covers socket errors, and attached files that could
+        # not be read while they were being sent
+        if not isinstance(err, (EnvironmentError, smtplib.SMTPException)):
+            raise
+        self.fail(err)
+
+
+class Dispatcher(object):
+    """
+    Feeds messages to up to max_sessions concurrent SMTPSessions and keeps
+    count of the outcomes.
+    """
+
+    def __init__(self, messages, max_sessions):
+        self.messages = iter(messages)
+        self.max_sessions = max_sessions
+        self.sessions = set()
+        self.waiting = None
+        self.exhausted = False
+        self.fallback = None
+        self.results = ResultBuffer()
+        self.sent_count = 0
+        self.deferred_count = 0
+
+    def take(self):
+        if self.waiting is not None:
+            message, self.waiting = self.waiting, None
+            return message
+        if not self.exhausted:
+            try:
+                return self.messages.next()
+            except StopIteration:
+                self.exhausted = True
+        return None
+
+    def next_message(self, params):
+        """
+        Return the next message if it is for a session with the given params,
+        or None if that session should close.
+        """
+
+        message = self.take()
+        if message is not None and session_params(message.connection_kwargs) != params:
+            # leave it for a new session
+            self.waiting = message
+            return None
+        return message
+
+    def fill(self):
+        while len(self.sessions) < self.max_sessions:
+            message = self.take()
+            if message is None:
+                return
+            params = session_params(message.connection_kwargs)
+            if params is None:
+                if self.fallback is None:
+                    self.fallback = MessageSender()
+                result = self.fallback.send(message)
+                if result:
+                    self.sent_count += 1
+                elif result is not None:
+                    self.deferred_count += 1
+                continue
+            try:
+                self.sessions.add(SMTPSession(self, params, message))
+            except socket.error, err:
+                self.deferred(message, err)
+
+    def sent(self, message):
+        self.results.sent(message)
+        self.sent_count += 1
+
+    def deferred(self, message, err):
+        self.results.deferred(message, err)
+        self.deferred_count += 1
+
+    def closed(self, session):
+        self.sessions.discard(session)
+
+    def run(self):
+        try:
+            while True:
+                self.fill()
+                if not self.sessions:
+                    break
+                asyncore.loop(timeout=0.1, count=1)
+                now = time.time()
+                for session in list(self.sessions):
+                    session.check_timeout(now)
+        finally:
+            for session in list(self.sessions):
+                session.fail(smtplib.SMTPServerDisconnected("delivery aborted"))
+            try:
+                self.results.flush()
+            finally:
+                if self.fallback is not None:
+                    self.fallback.close()
+        return self.sent_count, self.deferred_count
+
+
+def deliver(messages, sessions=None):
+    """
+    Send the given messages over up to sessions concurrent SMTP sessions
+    (MAILER_ASYNC_SESSIONS by default). Returns a (sent, deferred) tuple.
+    """
+
+    if sessions is None:
+        sessions = SESSIONS
+    return Dispatcher(messages, sessions).run()
+
+
+def send_all(sessions=None):
+    """
+    Send all eligible messages in the queue over up to sessions concurrent
+    SMTP sessions. Returns what mailer.engine.drain_queue() does.
+    """
+
+    return drain_queue(lambda messages: deliver(messages, sessions))
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    An in-process SMTP server that accepts every message and keeps it in
+    received as (mailfrom, rcpttos, data) tuples. It runs on the same asyncore
+    loop as this engine, so delivery can be exercised and timed without a
+    network:
+
+        sink = SMTPSink()
+        settings.EMAIL_HOST, settings.EMAIL_PORT = sink.address
+        async_engine.send_all()
+    """
+
+    def __init__(self, localaddr=("127.0.0.1", 0)):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.address = self.socket.getsockname()
+        self.received = []
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, data))
@@ -1,15 +1,40 @@
 from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends import smtp
 
+try:
+    # Django 1.4
+    from django.core.mail.message import sanitize_address
+except ImportError:
+    sanitize_address = lambda addr, encoding: addr
+
+from mailer.files import file_attachments, sendmail
 from mailer.models import Message
 
 
 class DbBackend(BaseEmailBackend):
     
     def send_messages(self, email_messages):
-        num_sent = 0
-        for email in email_messages:
-            msg = Message()
-            msg.email = email
-            msg.save()
-            num_sent += 1
-        return num_sent
+        return Message.objects.enqueue_many(email_messages)
+
+
+class SMTPBackend(smtp.EmailBackend):
+    """
+    Django's SMTP backend, except that messages with file attachments (see
+    mailer.files) are written to the server as they are encoded.
+    """
+    
+    def _send(self, email_message):
+        if not file_attachments(email_message):
+            return super(SMTPBackend, self)._send(email_message)
+        if not email_message.recipients():
+            return False
+        from_email = sanitize_address(email_message.from_email, email_message.encoding)
+        recipients = [sanitize_address(addr, email_message.encoding)
+                      for addr in email_message.recipients()]
+        try:
+            sendmail(self.connection, from_email, recipients, email_message.message())
+        except:
+            if not self.fail_silently:
+                raise
+            return False
+        return True
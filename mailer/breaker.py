@@ -0,0 +1,132 @@
+"""
+Stops senders from trying a mail server that is down.
+
+Each connection (each distinct set of connection arguments, see
+Message.connection_key) has a circuit breaker. After THRESHOLD connection
+failures in a row it opens, and messages for that connection are skipped:
+they are neither sent nor deferred, and go back to the queue as they were.
+After COOLDOWN seconds one message is let through as a probe. If it gets
+through, the breaker closes again; if not, it stays open for another
+COOLDOWN seconds.
+"""
+
+import time
+import logging
+import smtplib
+import threading
+
+from socket import error as socket_error
+
+from django.conf import settings
+
+
+# how many connection failures in a row open a breaker. None or 0 disables
+# circuit breaking.
+THRESHOLD = getattr(settings, "MAILER_BREAKER_THRESHOLD", 5)
+
+# how long (in seconds) an open breaker waits before letting a probe through.
+COOLDOWN = getattr(settings, "MAILER_BREAKER_COOLDOWN", 60)
+
+# errors that mean the server could not be reached or dropped the connection,
+# rather than that it refused a particular message.
+CONNECTION_ERRORS = (socket_error, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a message may be sent now. While open this is False, except
+        once per cooldown, for the probe.
+        """
+
+        self.lock.acquire()
+        try:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            logging.info("trying %s again" % self.name)
+            return True
+        finally:
+            self.lock.release()
+
+    def record(self, err=None):
+        """
+        Record the outcome of a send allowed by allow(): err is the exception
+        it failed with, if any.
+        """
+
+        self.lock.acquire()
+        try:
+            self.probing = False
+            if err is None or not isinstance(err, CONNECTION_ERRORS):
+                # the server answered, whatever it said
+                if self.opened_at is not None:
+                    logging.info("%s is back, closing its circuit" % self.name)
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning("%s failed %s times in a row, skipping its messages for %s seconds" % (
+                        self.name, self.failures, self.cooldown))
+                self.opened_at = time.time()
+        finally:
+            self.lock.release()
+
+
+class Breakers(object):
+    """
+    The circuit breakers of one process, by connection key. Shared by the
+    threads of one process; each process has its own.
+    """
+
+    def __init__(self, threshold=None, cooldown=None):
+        if threshold is None:
+            threshold = THRESHOLD
+        if cooldown is None:
+            cooldown = COOLDOWN
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, message):
+        """
+        The breaker for the connection message is sent over, or None if
+        circuit breaking is disabled.
+        """
+
+        kwargs = message.connection_kwargs or {}
+        name = "%s:%s" % (kwargs.get("host", getattr(settings, "EMAIL_HOST", "")),
+                          kwargs.get("port", getattr(settings, "EMAIL_PORT", "")))
+        return self.get_for(message.connection_key, name)
+
+    def get_for(self, key, name):
+        """
+        The breaker for the given connection key, named name in the log, or
+        None if circuit breaking is disabled.
+        """
+
+        if not self.threshold:
+            return None
+        self.lock.acquire()
+        try:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = self.breakers[key] = CircuitBreaker(name, self.threshold, self.cooldown)
+            return breaker
+        finally:
+            self.lock.release()
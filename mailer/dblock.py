@@ -0,0 +1,134 @@
+"""
+A lock kept in the database rather than on the local filesystem, so it
+keeps send_mail runs on different hosts from overlapping.
+
+It has the same interface and exceptions as the locks in mailer.lockfile.
+The holder renews its hold every HEARTBEAT seconds from a background thread.
+If the holder dies, its hold runs out TTL seconds after the last renewal, and
+the lock can then be taken by anyone. If the holder cannot renew in time, it
+sets lost, and the send in progress stops.
+"""
+
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_connection
+
+from mailer.lockfile import AlreadyLocked, LockTimeout, NotLocked, NotMyLock
+from mailer.models import Lock
+
+
+# how long (in seconds) a hold on the lock lasts without being renewed.
+TTL = getattr(settings, "MAILER_DB_LOCK_TTL", 10)
+
+# how often (in seconds) the holder renews its hold.
+HEARTBEAT = getattr(settings, "MAILER_DB_LOCK_HEARTBEAT", TTL / 3.0)
+
+
+class DatabaseLock(object):
+    """
+    The database lock with the given name, held as owner (see
+    mailer.engine.make_lease_owner).
+    """
+    
+    def __init__(self, name, owner, ttl=None, heartbeat=None):
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl or TTL
+        self.heartbeat = heartbeat or HEARTBEAT
+        self.stopped = None
+        self.thread = None
+        self.lost = False
+    
+    def acquire(self, timeout=None):
+        """
+        Acquire the lock.
+        
+        * If timeout is omitted (or None), wait forever trying to lock.
+        
+        * If timeout > 0, try to acquire the lock for that many seconds. If
+          it is still locked after that, raise LockTimeout.
+        
+        * If timeout <= 0, raise AlreadyLocked immediately if it is already
+          locked.
+        """
+        
+        end_time = time.time()
+        if timeout is not None and timeout > 0:
+            end_time += timeout
+        
+        if timeout is None:
+            wait = 0.5
+        else:
+            wait = min(max(0, timeout / 10.0), 0.5)
+        
+        while not Lock.objects.acquire(self.name, self.owner, self.ttl):
+            if timeout is not None and time.time() > end_time:
+                if timeout > 0:
+                    raise LockTimeout
+                else:
+                    raise AlreadyLocked
+            time.sleep(wait)
+        
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.renew, args=(self.stopped,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def renew(self, stopped):
+        renewed = time.time()
+        try:
+            while not stopped.wait(self.heartbeat):
+                try:
+                    held = Lock.objects.renew(self.name, self.owner, self.ttl)
+                except Exception:
+                    # e.g. the database went away; keep trying for as long
+                    # as the last renewal lasts
+                    logging.exception("could not renew the %s lock" % self.name)
+                    close_connection()
+                    if time.time() - renewed < self.ttl:
+                        continue
+                    held = False
+                if not held:
+                    # someone broke the lock, or we stalled past its expiry
+                    logging.warning("lost the %s lock" % self.name)
+                    self.lost = True
+                    return
+                renewed = time.time()
+        finally:
+            close_connection()
+    
+    def release(self):
+        """
+        Release the lock. Raises NotLocked if it is not locked and NotMyLock
+        if it is held by someone else.
+        """
+        
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        if not Lock.objects.release(self.name, self.owner):
+            if self.is_locked():
+                raise NotMyLock
+            raise NotLocked
+    
+    def is_locked(self):
+        return Lock.objects.held(self.name) is not None
+    
+    def i_am_locking(self):
+        lock = Lock.objects.held(self.name)
+        return lock is not None and lock.owner == self.owner
+    
+    def break_lock(self):
+        Lock.objects.filter(name=self.name).delete()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *_exc):
+        self.release()
@@ -1,13 +1,19 @@
+import os
+import sys
 import time
+import Queue
+import threading
+import uuid
+import socket
 import smtplib
 import logging
 
-from lockfile import FileLock, AlreadyLocked, LockTimeout
+from lockfile import FileLock, AlreadyLocked, LockTimeout, UnlockError
 from socket import error as socket_error
 
 from django.conf import settings
 from django.core.mail import send_mail as core_send_mail
-from django.db import transaction
+from django.db import transaction, close_connection
 
 try:
     # Django 1.2
@@ -18,7 +24,13 @@ except ImportError:
     get_connection = lambda backend=None, fail_silently=False, **kwds: SMTPConnection(fail_silently=fail_silently)
 
 
-from mailer.models import Message, DontSendEntry, MessageLog
+from mailer.dblock import DatabaseLock
+from mailer.files import MissingFile, check_files
+from mailer.models import Message, DontSendEntry, MessageLog, Attachment, MissingAttachment, add_counts
+from mailer.notify import Listener
+from mailer.relays import Relays
+from mailer.breaker import Breakers, CONNECTION_ERRORS
+from mailer.throttle import Throttle
 
 
 # when queue is empty, how long to wait (in seconds) before checking again
@@ -28,22 +40,114 @@ EMPTY_QUEUE_SLEEP = getattr(settings, "MAILER_EMPTY_QUEUE_SLEEP", 30)
 # default behavior is to never wait for the lock to be available.
 LOCK_WAIT_TIMEOUT = getattr(settings, "MAILER_LOCK_WAIT_TIMEOUT", -1)
 
-# The actual backend to use for sending, defaulting to the Django default.
-EMAIL_BACKEND = getattr(settings, "MAILER_EMAIL_BACKEND", "django.core.mail.backends.smtp.EmailBackend")
+# The actual backend to use for sending, defaulting to Django's SMTP backend
+# as extended by mailer.backend.SMTPBackend.
+EMAIL_BACKEND = getattr(settings, "MAILER_EMAIL_BACKEND", "mailer.backend.SMTPBackend")
 
+# how many messages to fetch from the queue with a single query. the queue is
+# checked again for newly arrived high priority mail between batches.
+BATCH_SIZE = getattr(settings, "MAILER_BATCH_SIZE", 500)
 
-def prioritize():
+# how long (in seconds) a worker holds its claim on a batch of messages. the
+# lease is renewed while the batch is being sent; messages held by a worker
+# that died become available again once it runs out.
+LEASE_SECONDS = getattr(settings, "MAILER_LEASE_SECONDS", 300)
+
+# whether send_all() should take the send lock. with leasing several workers
+# can safely drain the same queue, so this may be turned off.
+USE_FILE_LOCK = getattr(settings, "MAILER_USE_FILE_LOCK", True)
+
+# which send lock to take: "file" for a lock file, which only covers the local
+# host, or "database" for a lock shared by every host using the database.
+LOCK_BACKEND = getattr(settings, "MAILER_LOCK_BACKEND", "file")
+
+# how many threads send_all() delivers mail with. each thread has its own
+# connection to the mail server.
+SEND_CONCURRENCY = getattr(settings, "MAILER_SEND_CONCURRENCY", 1)
+
+# delivery outcomes are written to the database in groups, once this many
+# have been collected or this many seconds have passed since the last write.
+# if the process dies in between, messages whose outcome was not yet written
+# are sent again once their lease expires; set MAILER_FLUSH_SIZE to 1 to write
+# every outcome as it happens.
+FLUSH_SIZE = getattr(settings, "MAILER_FLUSH_SIZE", 100)
+FLUSH_INTERVAL = getattr(settings, "MAILER_FLUSH_INTERVAL", 5)
+
+# how many open connections each sender keeps, one per distinct set of
+# connection arguments. the least recently used one is closed to make room.
+CONNECTION_POOL_SIZE = getattr(settings, "MAILER_CONNECTION_POOL_SIZE", 10)
+
+# close pooled connections that have not been used for this many seconds.
+CONNECTION_IDLE_TIMEOUT = getattr(settings, "MAILER_CONNECTION_IDLE_TIMEOUT", 60)
+
+# reconnect after sending this many messages over one connection. None means
+# a connection is reused for as long as it stays healthy.
+CONNECTION_MAX_MESSAGES = getattr(settings, "MAILER_CONNECTION_MAX_MESSAGES", None)
+
+# how often (in seconds) the runmailer daemon sends a NOOP over its idle
+# connections, so the server does not drop them between passes.
+KEEPALIVE_INTERVAL = getattr(settings, "MAILER_KEEPALIVE_INTERVAL", 30)
+
+
+def make_lease_owner():
+    """
+    Return a name identifying this worker in Message.lease_owner.
+    """
+    
+    return ("%s:%s:%s" % (socket.gethostname(), os.getpid(),
+                          uuid.uuid4().hex[:8]))[-128:]
+
+
+def make_lock(owner):
+    """
+    Return the send lock selected by MAILER_LOCK_BACKEND, to be held as
+    owner.
+    """
+    
+    if LOCK_BACKEND == "database":
+        return DatabaseLock("send_mail", owner)
+    return FileLock("send_mail")
+
+
+def prioritize(owner=None, lock=None):
     """
     Yield the messages in the queue in the order they should be sent.
+    
+    Messages are leased to owner BATCH_SIZE at a time, so the number of
+    queries scales with the number of batches rather than the number of
+    messages, and concurrent workers never receive the same message.
+    
+    If lock is given, this stops as soon as the lock is lost (see
+    mailer.dblock).
     """
     
+    if owner is None:
+        owner = make_lease_owner()
     while True:
-        try:
-            yield Message.objects.non_deferred().order_by(
-                    "priority", "when_added")[0]
-        except IndexError:
-            # the [0] ref was out of range, so we're done with messages
+        if lock_lost(lock):
             break
+        batch = Message.objects.claim(owner, BATCH_SIZE, LEASE_SECONDS)
+        if not batch:
+            # nothing left in the queue, so we're done with messages
+            break
+        held = None
+        renew_at = time.time() + LEASE_SECONDS / 2.0
+        for message in batch:
+            if time.time() > renew_at:
+                held = Message.objects.renew(owner, [m.pk for m in batch], LEASE_SECONDS)
+                renew_at = time.time() + LEASE_SECONDS / 2.0
+            if held is not None and message.pk not in held:
+                # the lease ran out and another worker took the message
+                continue
+            if lock_lost(lock):
+                return
+            yield message
+
+def lock_lost(lock):
+    if getattr(lock, "lost", False):
+        logging.warning("lost the send lock. stopping.")
+        return True
+    return False
 
 @transaction.commit_on_success
 def mark_as_sent(message):
@@ -63,25 +167,500 @@ def mark_as_deferred(message, err=None):
 
     message.defer()
     logging.info("message deferred due to failure: %s" % err)
-    MessageLog.objects.log(message, 3, log_message=str(err)) # @@@ avoid using literal result code
+    MessageLog.objects.log(message, 3, log_message=str(err), error=err) # @@@ avoid using literal result code
+
+class ResultBuffer(object):
+    """
+    Collects the outcomes of delivery attempts and writes them in groups: in
+    one transaction, a bulk INSERT of the log entries, a single DELETE of the
+    sent messages and a single UPDATE deferring the failed ones.
+    
+    A ResultBuffer is not thread-safe; give each thread its own.
+    """
+    
+    def __init__(self, flush_size=None, flush_interval=None):
+        if flush_size is None:
+            flush_size = FLUSH_SIZE
+        if flush_interval is None:
+            flush_interval = FLUSH_INTERVAL
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.log_entries = []
+        self.sent_ids = []
+        self.sent_digests = []
+        self.deferred_messages = []
+        self.last_flush = time.time()
+    
+    def sent(self, message):
+        self.log_entries.append(MessageLog.objects.make_entry(message, 1)) # @@@ avoid using literal result code
+        self.sent_ids.append(message.pk)
+        if message.attachment_digests:
+            self.sent_digests.append(message.attachment_digests)
+        self.maybe_flush()
+    
+    def deferred(self, message, err=None):
+        logging.info("message deferred due to failure: %s" % err)
+        message.priority = "4"
+        self.log_entries.append(MessageLog.objects.make_entry(message, 3, log_message=str(err), error=err)) # @@@ avoid using literal result code
+        self.deferred_messages.append(message)
+        self.maybe_flush()
+    
+    def maybe_flush(self):
+        if (len(self.log_entries) >= self.flush_size or
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+    
+    @transaction.commit_on_success
+    def flush(self):
+        """
+        Write everything collected so far.
+        """
+        
+        # the log entry of a sent message takes over its references to stored
+        # attachments, so only deferred messages change the counts
+        counts = {}
+        for entry in self.log_entries:
+            add_counts(counts, entry.attachment_digests)
+        for digests in self.sent_digests:
+            add_counts(counts, digests, -1)
+        Attachment.objects.adjust(counts)
+        if self.log_entries:
+            if hasattr(MessageLog.objects, "bulk_create"):
+                # Django 1.4
+                MessageLog.objects.bulk_create(self.log_entries)
+            else:
+                for entry in self.log_entries:
+                    entry.save()
+        if self.sent_ids:
+            Message.objects.delete_ids(self.sent_ids)
+        if self.deferred_messages:
+            Message.objects.defer_many(self.deferred_messages)
+        self.log_entries = []
+        self.sent_ids = []
+        self.sent_digests = []
+        self.deferred_messages = []
+        self.last_flush = time.time()
 
-def send_all():
+class ConnectionPool(object):
     """
-    Send all eligible messages in the queue.
+    Open backend connections keyed by their connection arguments (see
+    Message.connection_key), so that
+    interleaved messages for different accounts each keep a warm connection
+    instead of reconnecting whenever the account changes.
+    
+    A ConnectionPool is not thread-safe; give each thread its own.
     """
     
-    lock = FileLock("send_mail")
+    def __init__(self, max_size=None, idle_timeout=None, max_messages=None):
+        if max_size is None:
+            max_size = CONNECTION_POOL_SIZE
+        if idle_timeout is None:
+            idle_timeout = CONNECTION_IDLE_TIMEOUT
+        if max_messages is None:
+            max_messages = CONNECTION_MAX_MESSAGES
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        # key -> [connection, last used, messages sent]
+        self.entries = {}
+    
+    def get(self, key, connection_kwargs, backend=None):
+        """
+        Return an open connection for the given key, creating one with
+        connection_kwargs (and backend, if not MAILER_EMAIL_BACKEND) if there
+        is none in the pool.
+        """
+        
+        now = time.time()
+        self.expire(now)
+        
+        entry = self.entries.get(key)
+        if entry is not None and self.max_messages and entry[2] >= self.max_messages:
+            self._close(key)
+            entry = None
+        if entry is None:
+            while self.entries and len(self.entries) >= self.max_size:
+                lru = min(self.entries, key=lambda k: self.entries[k][1])
+                self._close(lru)
+            if connection_kwargs:
+                connection = get_connection(backend=backend or EMAIL_BACKEND, **connection_kwargs)
+            else:
+                connection = get_connection(backend=backend or EMAIL_BACKEND)
+            # opening explicitly keeps the backend from closing the
+            # connection again after each message.
+            connection.open()
+            entry = self.entries[key] = [connection, now, 0]
+        entry[1] = now
+        entry[2] += 1
+        return entry[0]
+    
+    def expire(self, now=None):
+        """
+        Close connections that have not been used for idle_timeout seconds.
+        """
+        
+        if now is None:
+            now = time.time()
+        for key, entry in self.entries.items():
+            if now - entry[1] > self.idle_timeout:
+                self._close(key)
+    
+    def keepalive(self):
+        """
+        Expire idle connections and send a NOOP over the rest, dropping any
+        the server no longer answers. A NOOP does not count as use, so
+        connections still expire after idle_timeout seconds.
+        """
+        
+        self.expire()
+        for key, entry in self.entries.items():
+            # the SMTP backend keeps its smtplib.SMTP instance here
+            smtp = getattr(entry[0], "connection", None)
+            if smtp is None or not hasattr(smtp, "noop"):
+                continue
+            try:
+                alive = smtp.noop()[0] == 250
+            except (socket_error, smtplib.SMTPException):
+                alive = False
+            if not alive:
+                logging.debug("dropping connection that did not answer NOOP")
+                self._close(key)
+    
+    def discard(self, key, quit=True):
+        """
+        Drop the connection for the given key, e.g. after it has failed.
+        Unless quit is set, the connection is closed without a QUIT, as for
+        one left in the middle of a command.
+        """
+        
+        if quit:
+            self._close(key)
+            return
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        # the SMTP backend keeps its smtplib.SMTP instance here
+        smtp = getattr(entry[0], "connection", None)
+        if smtp is not None and hasattr(smtp, "close"):
+            smtp.close()
+            entry[0].connection = None
+    
+    def close(self):
+        """
+        Close every connection in the pool.
+        """
+        
+        for key in self.entries.keys():
+            self._close(key)
+    
+    def _close(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        try:
+            entry[0].close()
+        except Exception, err:
+            logging.debug("error closing connection: %s" % err)
+
+def watch_mail(smtp):
+    """
+    Record the reply codes smtp gets to MAIL FROM in the list returned, until
+    "del smtp.mail".
+    """
+    
+    replies = []
+    mail = smtp.mail
+    
+    def watched(*args, **kwargs):
+        reply = mail(*args, **kwargs)
+        replies.append(reply[0])
+        return reply
+    
+    smtp.mail = watched
+    return replies
+
+class MessageSender(object):
+    """
+    Sends queued messages one at a time over connections from its own
+    ConnectionPool, recording the outcomes in its own ResultBuffer. Call
+    close() when done so the last outcomes are written.
+    
+    Sends are paced by throttle (see mailer.throttle), servers that are down
+    are skipped by breakers (see mailer.breaker) and messages without
+    connection arguments of their own are spread across relays (see
+    mailer.relays). Threads sending to the same servers should share all
+    three.
+    
+    A MessageSender is not thread-safe; give each thread its own.
+    """
+    
+    def __init__(self, throttle=None, breakers=None, relays=None):
+        self.pool = ConnectionPool()
+        self.results = ResultBuffer()
+        if throttle is None:
+            throttle = Throttle()
+        if breakers is None:
+            breakers = Breakers()
+        if relays is None:
+            relays = Relays()
+        self.throttle = throttle
+        self.breakers = breakers
+        self.relays = relays
+    
+    def send(self, message):
+        """
+        Send the given message and record the outcome. Returns True if the
+        message was sent, False if it was deferred and None if it was
+        skipped because its server is down, in which case it is left as it
+        is.
+        """
+        
+        try:
+            check_files(message.email)
+        except (MissingAttachment, MissingFile), err:
+            # it can never be sent as it was queued
+            return self.record(message, err)
+        if self.relays and not message.connection_kwargs:
+            return self.send_relayed(message)
+        
+        breaker = self.breakers.get(message)
+        if breaker is not None and not breaker.allow():
+            return None
+        return self.record(message, self.attempt(message, message.connection_key,
+                                                 message.connection_kwargs, breaker))
+    
+    def send_relayed(self, message):
+        """
+        Like send(), but over the relays, moving on to the next one for as
+        long as a relay cannot be reached.
+        """
+        
+        error = None
+        tried = False
+        for relay, breaker in self.relays.choose(self.breakers):
+            tried = True
+            self.relays.started(relay)
+            try:
+                error = self.attempt(message, relay.key, relay.connection_kwargs, breaker, relay.backend)
+            finally:
+                self.relays.finished(relay)
+            if not isinstance(error, CONNECTION_ERRORS):
+                break
+            logging.info("relay %s failed: %s" % (relay.name, error))
+        if not tried:
+            # every relay is down
+            return None
+        return self.record(message, error)
+    
+    def attempt(self, message, key, connection_kwargs, breaker=None, backend=None):
+        """
+        Try to send message over the pooled connection for key and return
+        the error it failed with, or None if it was sent.
+        """
+        
+        started = self.throttle.start(message, key)
+        error = None
+        try:
+            error, stale = self.send_once(message, key, connection_kwargs, backend)
+            if stale:
+                # the server dropped the connection while it sat in the pool,
+                # which says nothing about the server or the message
+                logging.debug("retrying on a new connection: %s" % error)
+                error, stale = self.send_once(message, key, connection_kwargs, backend)
+        finally:
+            self.throttle.finish(started, error)
+            if breaker is not None:
+                breaker.record(error)
+        return error
+    
+    def send_once(self, message, key, connection_kwargs, backend=None):
+        """
+        Send message over the pooled connection for key. Returns the error it
+        failed with, or None, and whether it failed because a connection
+        reused from the pool had been dropped before the server accepted the
+        MAIL FROM, in which case nothing was sent and it can be tried again.
+        """
+        
+        error = None
+        replies = None
+        try:
+            connection = self.pool.get(key, connection_kwargs, backend)
+            # the SMTP backend keeps its smtplib.SMTP instance here
+            smtp = getattr(connection, "connection", None)
+            if self.pool.entries[key][2] > 1 and hasattr(smtp, "mail"):
+                replies = watch_mail(smtp)
+            logging.info("sending message '%s' to %s" % (message.subject.encode("utf-8"), message.to_addresses.encode("utf-8")))
+            email = message.email
+            email.connection = connection
+            try:
+                email.send()
+            finally:
+                if replies is not None:
+                    del smtp.mail
+        except (socket_error, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError,
+                smtplib.SMTPAuthenticationError), err:
+            error = err
+            # Get new connection, it case the connection itself has an error.
+            self.pool.discard(key)
+        except EnvironmentError, err:
+            # reading an attached file failed, possibly halfway through
+            # DATA, where the server would not answer a QUIT
+            error = err
+            self.pool.discard(key, quit=False)
+        stale = (replies is not None and 250 not in replies and
+                 isinstance(error, (socket_error, smtplib.SMTPServerDisconnected)))
+        return error, stale
+    
+    def record(self, message, error):
+        if error is None:
+            self.results.sent(message)
+            return True
+        self.results.deferred(message, error)
+        return False
+    
+    def close(self):
+        try:
+            self.results.flush()
+        finally:
+            self.pool.close()
+
+def send_concurrently(messages, concurrency, breakers=None):
+    """
+    Send the given messages from a pool of concurrency threads, each with its
+    own MessageSender and database connection, sharing a Throttle, Breakers
+    (breakers, if given, to keep their state from an earlier pass) and
+    Relays. Returns a (sent, deferred)
+    tuple. An unexpected error in any thread stops the run and is re-raised
+    once all threads have finished.
+    """
+    
+    queue = Queue.Queue(concurrency * 2)
+    throttle = Throttle(concurrency)
+    if breakers is None:
+        breakers = Breakers()
+    relays = Relays()
+    counts = {True: 0, False: 0, None: 0}
+    counts_lock = threading.Lock()
+    errors = []
+    
+    def worker():
+        sender = MessageSender(throttle, breakers, relays)
+        try:
+            while True:
+                message = queue.get()
+                if message is None:
+                    break
+                if errors:
+                    # keep draining the queue so the feeder never blocks
+                    continue
+                try:
+                    result = sender.send(message)
+                except Exception:
+                    errors.append(sys.exc_info())
+                    continue
+                counts_lock.acquire()
+                try:
+                    counts[result] += 1
+                finally:
+                    counts_lock.release()
+        finally:
+            sender.close()
+            close_connection()
+    
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for message in messages:
+            if errors:
+                break
+            queue.put(message)
+    finally:
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return counts[True], counts[False]
+
+def send_serially(messages, breakers=None):
+    """
+    Send the given messages one after another over a single MessageSender,
+    using breakers if given. Returns a (sent, deferred) tuple.
+    """
+    
+    sender = MessageSender(breakers=breakers)
+    sent = 0
+    deferred = 0
+    try:
+        for message in messages:
+            result = sender.send(message)
+            if result:
+                sent += 1
+            elif result is not None:
+                deferred += 1
+    finally:
+        sender.close()
+    return sent, deferred
+
+def take_lock(owner):
+    """
+    Take the send lock as owner and return it, or return None if it is
+    held by someone else.
+    """
+    
+    lock = make_lock(owner)
     
     logging.debug("acquiring lock...")
     try:
         lock.acquire(LOCK_WAIT_TIMEOUT)
     except AlreadyLocked:
         logging.debug("lock already in place. quitting.")
-        return
+        return None
     except LockTimeout:
         logging.debug("waiting for the lock timed out. quitting.")
-        return
+        return None
     logging.debug("acquired.")
+    return lock
+
+def release_lock(lock):
+    logging.debug("releasing lock...")
+    try:
+        lock.release()
+    except UnlockError, err:
+        # e.g. a database lock that ran out while we were sending
+        logging.warning("could not release the lock: %r" % err)
+    else:
+        logging.debug("released.")
+
+def drain_queue(deliver, use_lock=None):
+    """
+    Take the send lock and hand the prioritized queue to deliver, which must
+    send or defer every message it is given and return a (sent, deferred)
+    tuple. Returns that tuple, or None if the lock could not be taken.
+    
+    deliver may also stop early; whatever it does not get to is handed back
+    to the queue.
+    
+    use_lock defaults to USE_FILE_LOCK. Workers that rely on leasing alone to
+    share the queue pass False.
+    """
+    
+    if use_lock is None:
+        use_lock = USE_FILE_LOCK
+    
+    owner = make_lease_owner()
+    
+    lock = None
+    if use_lock:
+        lock = take_lock(owner)
+        if lock is None:
+            return None
     
     start_time = time.time()
     
@@ -90,47 +669,127 @@ def send_all():
     sent = 0
     
     try:
-        connection = None
-        lastConnectionArgs = None
-        for message in prioritize():
-            try:
-                #Check to see if we can reuse the last connection - except the password (we assume they're the same if user is the same)
-                if (connection is None) or (lastConnectionArgs != message.connection_kwargs):
-                    #Connection doesn't exist or doesn't match, build it
-                    if message.connection_kwargs:
-                        connection = get_connection(backend=EMAIL_BACKEND, **message.connection_kwargs)
-                    else:
-                        connection = get_connection(backend=EMAIL_BACKEND)
-                    #save the new args - even if they're empty
-                    lastConnectionArgs = message.connection_kwargs
-                logging.info("sending message '%s' to %s" % (message.subject.encode("utf-8"), message.to_addresses.encode("utf-8")))
-                email = message.email
-                email.connection = connection
-                email.send()
-                mark_as_sent(message)
-                sent += 1
-            except (socket_error, smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPAuthenticationError), err:
-                mark_as_deferred(message, err)
-                deferred += 1
-                # Get new connection, it case the connection itself has an error.
-                connection = None
+        sent, deferred = deliver(prioritize(owner, lock))
     finally:
-        logging.debug("releasing lock...")
-        lock.release()
-        logging.debug("released.")
+        # hand back anything we claimed but did not get to
+        Message.objects.release(owner)
+        if use_lock:
+            release_lock(lock)
     
     logging.info("")
     logging.info("%s sent; %s deferred;" % (sent, deferred))
     logging.info("done in %.2f seconds" % (time.time() - start_time))
+    return sent, deferred
+
+def send_all(concurrency=None, use_lock=None, breakers=None):
+    """
+    Send all eligible messages in the queue, using concurrency threads
+    (MAILER_SEND_CONCURRENCY by default). Returns what drain_queue() does.
+    
+    Callers making several passes should pass the same Breakers to each, so
+    that a server found down stays skipped for its cooldown.
+    """
+    
+    if concurrency is None:
+        concurrency = SEND_CONCURRENCY
+    
+    if concurrency > 1:
+        return drain_queue(lambda messages: send_concurrently(messages, concurrency, breakers), use_lock)
+    else:
+        return drain_queue(lambda messages: send_serially(messages, breakers), use_lock)
 
 def send_loop():
     """
-    Loop indefinitely, checking queue at intervals of EMPTY_QUEUE_SLEEP and
-    sending messages if any are on queue.
+    Loop indefinitely, sending messages as soon as they are queued. Between
+    passes it waits to be notified of new mail (see mailer.notify), checking
+    the queue at least every EMPTY_QUEUE_SLEEP seconds in case a notification
+    is missed or not available.
     """
     
-    while True:
-        while not Message.objects.all():
-            logging.debug("sleeping for %s seconds before checking queue again" % EMPTY_QUEUE_SLEEP)
-            time.sleep(EMPTY_QUEUE_SLEEP)
-        send_all()
+    # listen before the first check, so nothing queued in between is missed
+    listener = Listener(Message.objects.db)
+    breakers = Breakers()
+    try:
+        while True:
+            while not Message.objects.available().exists():
+                logging.debug("waiting up to %s seconds for mail to be queued" % EMPTY_QUEUE_SLEEP)
+                listener.wait(EMPTY_QUEUE_SLEEP)
+            result = send_all(breakers=breakers)
+            if not result or not sum(result):
+                # the lock is held elsewhere, or every message left is for a
+                # server that is down; don't go straight back for them
+                logging.debug("nothing sent, waiting up to %s seconds" % EMPTY_QUEUE_SLEEP)
+                listener.wait(EMPTY_QUEUE_SLEEP)
+    finally:
+        listener.close()
+
+class Daemon(object):
+    """
+    Sends mail for as long as it runs, like send_loop(), but keeps a single
+    MessageSender across passes so connections stay open between them, with
+    a NOOP sent over idle ones every KEEPALIVE_INTERVAL seconds.
+    
+    stop() makes run() return once the message being sent is done and the
+    outstanding results are written; it is safe to call from a signal
+    handler. use_lock is passed on to drain_queue(), and report, if given, is
+    called with the (sent, deferred) tuple of each pass.
+    """
+    
+    def __init__(self, use_lock=None, report=None):
+        self.stopping = False
+        self.sender = None
+        self.use_lock = use_lock
+        self.report = report
+    
+    def stop(self):
+        self.stopping = True
+    
+    def deliver(self, messages):
+        sent = 0
+        deferred = 0
+        for message in messages:
+            if self.stopping:
+                # the rest are released back to the queue
+                break
+            try:
+                result = self.sender.send(message)
+            except Exception, err:
+                # record it before going down, so a restarted worker does not
+                # pick the same message straight back up. written now, while
+                # the messages are still leased to us, rather than after
+                # drain_queue() has released them.
+                exc_info = sys.exc_info()
+                self.sender.results.deferred(message, err)
+                self.sender.results.flush()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if result:
+                sent += 1
+            elif result is not None:
+                deferred += 1
+        self.sender.results.flush()
+        return sent, deferred
+    
+    def run(self):
+        # listen before the first check, so nothing queued in between is missed
+        listener = Listener(Message.objects.db)
+        self.sender = MessageSender()
+        next_keepalive = time.time() + KEEPALIVE_INTERVAL
+        try:
+            while not self.stopping:
+                result = None
+                if Message.objects.available().exists():
+                    result = drain_queue(self.deliver, self.use_lock)
+                    if result and self.report is not None:
+                        self.report(result)
+                if result and sum(result):
+                    # there may be more, check again straight away
+                    continue
+                timeout = max(0, min(EMPTY_QUEUE_SLEEP, next_keepalive - time.time()))
+                logging.debug("waiting up to %.0f seconds for mail to be queued" % timeout)
+                listener.wait(timeout)
+                if time.time() >= next_keepalive:
+                    self.sender.pool.keepalive()
+                    next_keepalive = time.time() + KEEPALIVE_INTERVAL
+        finally:
+            listener.close()
+            self.sender.close()
@@ -0,0 +1,39 @@
+from django.db import models
+
+
+class BlobField(models.Field):
+    """
+    A field holding a byte string in a binary column.
+    """
+
+    __metaclass__ = models.SubfieldBase
+
+    def db_type(self, connection):
+        vendor = getattr(connection, "vendor", None)
+        if vendor == "postgresql":
+            return "bytea"
+        elif vendor == "mysql":
+            return "longblob"
+        return "blob"
+
+    def to_python(self, value):
+        # database adapters hand binary columns back as buffer objects
+        if isinstance(value, buffer):
+            return str(value)
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is None:
+            return None
+        if getattr(connection, "vendor", None) in ("postgresql", "sqlite"):
+            # so the adapter sends the value as binary rather than text
+            return buffer(value)
+        return value
+
+
+try:
+    from south.modelsinspector import add_introspection_rules
+except ImportError:
+    pass
+else:
+    add_introspection_rules([], ["^mailer\.fields\.BlobField"])
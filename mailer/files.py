@@ -0,0 +1,289 @@
+"""
+Attachments kept in file storage rather than in the queue.
+
+A FileAttachment stands for a file in Django file storage and is attached to
+an EmailMessage like any other MIME part:
+
+    from mailer.files import attach_file
+
+    email.attach(attach_file("reports/2013.pdf"))
+    email.attach(attach_file(request.FILES["upload"]))
+
+Only the path is stored with the message. The file is read when the message
+is sent, in chunks, and the SMTP backends here write it to the server as it
+is encoded, so the whole message is never held in memory.
+"""
+
+import os
+import re
+import uuid
+import base64
+import smtplib
+import tempfile
+import mimetypes
+
+from email.generator import Generator
+from email.mime.base import MIMEBase
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage, get_storage_class
+
+
+# the storage holding attached files, as the import path of a storage class,
+# or None for DEFAULT_FILE_STORAGE.
+ATTACHMENT_STORAGE = getattr(settings, "MAILER_ATTACHMENT_STORAGE", None)
+
+# where in that storage to keep files attached from file handles.
+ATTACHMENT_UPLOAD_TO = getattr(settings, "MAILER_ATTACHMENT_UPLOAD_TO", "mailer/attachments")
+
+# how many bytes of a file to read at once; a multiple of 57 so that each
+# chunk encodes to whole base64 lines.
+CHUNK_SIZE = 57 * 1024
+
+CRLF = "\r\n"
+
+
+def get_storage():
+    if ATTACHMENT_STORAGE:
+        return get_storage_class(ATTACHMENT_STORAGE)()
+    return default_storage
+
+
+class FileAttachment(MIMEBase):
+    """
+    A base64-encoded MIME part whose content is read from file storage when
+    it is needed. key is set for files copied into storage by attach_file(),
+    which are deleted once no message or log entry refers to them. Until the
+    first message with it is saved, such a file is read from source, which
+    is kept so that the file can be stored again should that save be rolled
+    back.
+    """
+
+    def __init__(self, path, filename=None, mimetype=None, key=None, size=None, source=None):
+        if filename is None:
+            filename = os.path.basename(path)
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        maintype, subtype = mimetype.split("/", 1)
+        MIMEBase.__init__(self, maintype, subtype)
+        self["Content-Transfer-Encoding"] = "base64"
+        if isinstance(filename, unicode):
+            try:
+                filename = filename.encode("ascii")
+            except UnicodeEncodeError:
+                filename = ("utf-8", "", filename.encode("utf-8"))
+        self.add_header("Content-Disposition", "attachment", filename=filename)
+        self.path = path
+        self.key = key
+        self.size = size
+        self.source = source
+        self.stored = False
+
+    def __getstate__(self):
+        # the file handle stays behind; the message is stored after the file
+        state = self.__dict__.copy()
+        state["source"] = None
+        return state
+
+    def store(self):
+        """
+        Copy the file handle given to attach_file() into storage, unless it
+        is there already.
+        """
+
+        if self.source is None:
+            return
+        storage = get_storage()
+        if self.stored and storage.exists(self.path):
+            return
+        self.source.seek(0)
+        content = File(self.source)
+        content.size = self.size
+        path = storage.save(self.path, content)
+        if path != self.path:
+            storage.delete(path)
+            raise IOError("could not store %s, it already exists" % self.path)
+        self.stored = True
+
+    def open(self):
+        return get_storage().open(self.path, "rb")
+
+    def chunks(self):
+        """
+        The content of the file, CHUNK_SIZE bytes at a time.
+        """
+
+        if self.source is not None and not self.stored:
+            f = self.source
+            f.seek(0)
+        else:
+            f = self.open()
+        try:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if f is not self.source:
+                f.close()
+
+    def encoded_chunks(self):
+        """
+        The payload, base64-encoded, one chunk at a time.
+        """
+
+        for chunk in self.chunks():
+            yield base64.encodestring(chunk)
+
+    def get_payload(self, i=None, decode=False):
+        # for anything that renders the message without streaming it
+        if decode:
+            return "".join(self.chunks())
+        return "".join(self.encoded_chunks())
+
+
+def attach_file(source, filename=None, mimetype=None):
+    """
+    A FileAttachment for source: either the path of a file already in
+    storage, which is left in place, or a file handle. The content of a file
+    handle is copied into storage under ATTACHMENT_UPLOAD_TO when the first
+    message with it is saved, so it must stay open until then. A handle that
+    cannot seek is first copied to a temporary file.
+    """
+
+    if isinstance(source, basestring):
+        return FileAttachment(source, filename, mimetype)
+    if filename is None:
+        filename = os.path.basename(getattr(source, "name", "") or "") or "attachment"
+    try:
+        source.seek(0, 2)
+        size = source.tell()
+        source.seek(0)
+    except (AttributeError, IOError):
+        spooled = tempfile.TemporaryFile()
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            spooled.write(chunk)
+        size = spooled.tell()
+        source = spooled
+    key = uuid.uuid4().hex
+    return FileAttachment("%s/%s" % (ATTACHMENT_UPLOAD_TO, key), filename, mimetype,
+                          key=key, size=size, source=source)
+
+
+def file_attachments(email):
+    return [a for a in getattr(email, "attachments", None) or [] if isinstance(a, FileAttachment)]
+
+
+class MissingFile(IOError):
+    """
+    A message has file attachments whose files are no longer in storage.
+    paths lists them.
+    """
+
+    def __init__(self, paths):
+        IOError.__init__(self, "attached file missing: %s" % ", ".join(paths))
+        self.paths = paths
+
+
+def check_files(email):
+    """
+    Raise MissingFile if the file of any FileAttachment on email is gone, so
+    that the message can be given up on before it is half sent.
+    """
+
+    attachments = [a for a in file_attachments(email) if a.source is None or a.stored]
+    if not attachments:
+        return
+    storage = get_storage()
+    missing = [a.path for a in attachments if not storage.exists(a.path)]
+    if missing:
+        raise MissingFile(missing)
+
+
+class MarkingGenerator(Generator):
+    """
+    Writes a marker in place of the payload of each FileAttachment, which is
+    kept in files, so that it can be streamed in afterwards.
+    """
+
+    def __init__(self, outfp, mangle_from_=True, maxheaderlen=78, token=None, files=None):
+        Generator.__init__(self, outfp, mangle_from_, maxheaderlen)
+        self.token = token or uuid.uuid4().hex
+        self.files = files if files is not None else []
+
+    def clone(self, fp):
+        return self.__class__(fp, self._mangle_from_, self._maxheaderlen, self.token, self.files)
+
+    def _dispatch(self, msg):
+        if isinstance(msg, FileAttachment):
+            self._fp.write("\0%s:%d\0" % (self.token, len(self.files)))
+            self.files.append(msg)
+        else:
+            Generator._dispatch(self, msg)
+
+
+def data_chunks(msg):
+    """
+    The email.message.Message msg as sent after the SMTP DATA command: with
+    CRLF line endings, leading dots doubled and the final ".", a chunk at a
+    time. The files of its FileAttachments are read as they are reached.
+    """
+
+    fp = StringIO()
+    g = MarkingGenerator(fp, mangle_from_=False)
+    g.flatten(msg)
+    last = ""
+    pieces = re.split("\0%s:(\\d+)\0" % g.token, fp.getvalue())
+    for i, piece in enumerate(pieces):
+        if i % 2:
+            # base64 lines never start with a dot
+            for chunk in g.files[int(piece)].encoded_chunks():
+                chunk = chunk.replace("\n", CRLF)
+                last = chunk
+                yield chunk
+        elif piece:
+            piece = smtplib.quotedata(piece)
+            last = piece
+            yield piece
+    if last[-2:] != CRLF:
+        yield CRLF
+    yield "." + CRLF
+
+
+def sendmail(connection, from_addr, to_addrs, msg):
+    """
+    smtplib.SMTP.sendmail() for an email.message.Message, writing the data
+    to the server in chunks instead of as one string.
+    """
+
+    connection.ehlo_or_helo_if_needed()
+    code, resp = connection.mail(from_addr)
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = connection.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    connection.putcmd("data")
+    code, resp = connection.getreply()
+    if code != 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in data_chunks(msg):
+        connection.send(chunk)
+    code, resp = connection.getreply()
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
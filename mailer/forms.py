@@ -20,7 +20,9 @@ class MessageForm(forms.ModelForm):
             if not kwargs.get('initial'):
                 kwargs['initial'] = {}
             kwargs['initial']['from_email'] = instance.from_address
-            kwargs['initial']['to'] = instance.to_addresses
+            # to_addresses is cut short for long recipient lists
+            email = instance.email
+            kwargs['initial']['to'] = email is not None and u", ".join(email.to) or u""
             kwargs['initial']['subject'] = instance.subject
             kwargs['initial']['body'] = instance.body
             kwargs['initial']['body_html'] = instance.body_html
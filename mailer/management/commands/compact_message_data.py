@@ -0,0 +1,52 @@
+import logging
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from mailer.models import Message, MessageLog, db_to_object, object_to_blob
+
+
+class Command(NoArgsCommand):
+    help = "Rewrite messages and log entries stored in the old base64-pickled format."
+    option_list = NoArgsCommand.option_list + (
+        make_option("--chunk-size", type="int", dest="chunk_size", default=500,
+            help="Number of rows to rewrite per transaction."),
+    )
+
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        for model in (Message, MessageLog):
+            count = compact(model, options["chunk_size"])
+            logging.info("%s %s row(s) rewritten" % (count, model._meta.object_name))
+
+
+def compact(model, chunk_size):
+    """
+    Move the message_data of every legacy row of model into message_blob,
+    chunk_size rows per transaction. Returns the number of rows rewritten.
+    """
+
+    count = 0
+    last_pk = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=last_pk).exclude(message_data="")
+                    .order_by("pk").values_list("pk", "message_data")[:chunk_size])
+        if not rows:
+            return count
+        count += compact_rows(model, rows)
+        last_pk = rows[-1][0]
+
+
+@transaction.commit_on_success
+def compact_rows(model, rows):
+    count = 0
+    for pk, data in rows:
+        thing = db_to_object(data)
+        if thing is None:
+            logging.warning("could not decode %s %s, leaving it as it is" % (model._meta.object_name, pk))
+            continue
+        model.objects.filter(pk=pk).update(message_blob=object_to_blob(thing), message_data="")
+        count += 1
+    return count
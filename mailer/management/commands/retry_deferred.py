@@ -1,14 +1,23 @@
 import logging
 
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
 
+from mailer import PRIORITY_MAPPING
 from mailer.models import Message
 
 
 class Command(NoArgsCommand):
-    help = "Attempt to resend any deferred mail."
+    help = "Attempt to resend any deferred mail that is due to be retried."
+    option_list = NoArgsCommand.option_list + (
+        make_option("--priority", type="choice", choices=["high", "medium", "low"], dest="priority", default="medium",
+            help="Priority to put the retried mail back on the queue with."),
+        make_option("--limit", type="int", dest="limit", default=None,
+            help="Retry at most this many messages, the longest waiting first."),
+    )
     
     def handle_noargs(self, **options):
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
-        count = Message.objects.retry_deferred() # @@@ new_priority not yet supported
+        count = Message.objects.retry_deferred(PRIORITY_MAPPING[options["priority"]], limit=options["limit"])
         logging.info("%s message(s) retried" % count)
@@ -0,0 +1,67 @@
+import os
+import sys
+import signal
+import logging
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from mailer.engine import Daemon
+
+
+# allow a sysadmin to pause the sending of mail temporarily.
+PAUSE_SEND = getattr(settings, "MAILER_PAUSE_SEND", False)
+
+
+class Command(NoArgsCommand):
+    help = ("Send mail as it is queued until stopped. SIGTERM or SIGINT stop it "
+            "once the message being sent is done; SIGHUP does the same and then "
+            "restarts it in place to pick up changed settings.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--processes", type="int", dest="processes", default=1,
+            help="Number of worker processes to send mail with. Workers share the "
+                 "queue by leasing and do not take the lock file."),
+    )
+    
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        if options["processes"] > 1:
+            from mailer import prefork
+            daemon = prefork.Supervisor(options["processes"], prefork.daemon_worker, keep_running=True)
+        else:
+            daemon = Daemon()
+        reload = []
+        
+        def stop(signum, frame):
+            logging.info("stopping once the current message is done...")
+            daemon.stop()
+        
+        def restart(signum, frame):
+            logging.info("reloading once the current message is done...")
+            reload.append(True)
+            daemon.stop()
+        
+        for signum, handler in ((signal.SIGTERM, stop), (signal.SIGINT, stop), (signal.SIGHUP, restart)):
+            signal.signal(signum, handler)
+            # let a send in progress carry on rather than fail with EINTR
+            signal.siginterrupt(signum, False)
+        
+        if PAUSE_SEND:
+            logging.info("sending is paused, waiting for a signal.")
+            while not daemon.stopping:
+                signal.pause()
+        else:
+            daemon.run()
+        
+        if options["processes"] > 1:
+            logging.info("all workers: %s sent; %s deferred;" % (daemon.sent, daemon.deferred))
+        if reload:
+            # settings are read at import time, so start over with a fresh
+            # interpreter; the process id stays the same.
+            logging.info("reloading.")
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        logging.info("stopped.")
@@ -1,7 +1,9 @@
 import logging
 
+from optparse import make_option
+
 from django.conf import settings
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import NoArgsCommand, CommandError
 
 from mailer.engine import send_all
 
@@ -12,12 +14,30 @@ PAUSE_SEND = getattr(settings, "MAILER_PAUSE_SEND", False)
 
 class Command(NoArgsCommand):
     help = "Do one pass through the mail queue, attempting to send all mail."
+    option_list = NoArgsCommand.option_list + (
+        make_option("--concurrency", type="int", dest="concurrency", default=None,
+            help="Number of threads to send mail with. Defaults to MAILER_SEND_CONCURRENCY."),
+        make_option("--engine", type="choice", choices=["default", "async"], dest="engine", default="default",
+            help="Delivery engine to use: 'default' sends through MAILER_EMAIL_BACKEND, "
+                 "'async' speaks SMTP directly over many sessions at once."),
+        make_option("--processes", type="int", dest="processes", default=1,
+            help="Number of worker processes to send mail with, each using --concurrency threads. "
+                 "Workers share the queue by leasing; the parent process holds the lock file."),
+    )
     
     def handle_noargs(self, **options):
+        if options["processes"] > 1 and options["engine"] != "default":
+            raise CommandError("--processes only works with the default engine.")
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
         logging.info("-" * 72)
         # if PAUSE_SEND is turned on don't do anything.
-        if not PAUSE_SEND:
-            send_all()
-        else:
+        if PAUSE_SEND:
             logging.info("sending is paused, quitting.")
+        elif options["engine"] == "async":
+            from mailer import async_engine
+            async_engine.send_all()
+        elif options["processes"] > 1:
+            from mailer import prefork
+            prefork.send_all(options["processes"], concurrency=options["concurrency"])
+        else:
+            send_all(concurrency=options["concurrency"])
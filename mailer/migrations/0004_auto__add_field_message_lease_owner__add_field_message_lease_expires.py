@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Message.lease_owner'
+        db.add_column('mailer_message', 'lease_owner',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=128, db_index=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'Message.lease_expires'
+        db.add_column('mailer_message', 'lease_expires',
+                      self.gf('django.db.models.fields.DateTimeField')(db_index=True, null=True, blank=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Message.lease_owner'
+        db.delete_column('mailer_message', 'lease_owner')
+
+        # Deleting field 'Message.lease_expires'
+        db.delete_column('mailer_message', 'lease_expires')
+
+
+    models = {
+        'mailer.dontsendentry': {
+            'Meta': {'object_name': 'DontSendEntry'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'to_address': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.message': {
+            'Meta': {'object_name': 'Message'},
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lease_expires': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'lease_owner': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '128', 'db_index': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {}),
+            'priority': ('django.db.models.fields.CharField', [], {'default': "'2'", 'max_length': '1'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.messagelog': {
+            'Meta': {'object_name': 'MessageLog'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log_message': ('django.db.models.fields.TextField', [], {}),
+            'message_data': ('django.db.models.fields.TextField', [], {}),
+            'priority': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'result': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'when_attempted': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['mailer']
\ No newline at end of file
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Message.subject'
+        db.add_column('mailer_message', 'subject',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=255, blank=True),
+                      keep_default=False)
+
+        # Adding field 'Message.to_addresses'
+        db.add_column('mailer_message', 'to_addresses',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=255, db_index=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'Message.from_address'
+        db.add_column('mailer_message', 'from_address',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=255, db_index=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'MessageLog.subject'
+        db.add_column('mailer_messagelog', 'subject',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=255, blank=True),
+                      keep_default=False)
+
+        # Adding field 'MessageLog.to_addresses'
+        db.add_column('mailer_messagelog', 'to_addresses',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=255, db_index=True, blank=True),
+                      keep_default=False)
+
+        # Adding field 'MessageLog.from_address'
+        db.add_column('mailer_messagelog', 'from_address',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=255, db_index=True, blank=True),
+                      keep_default=False)
+
+        # Adding index on 'MessageLog', fields ['when_attempted']
+        db.create_index('mailer_messagelog', ['when_attempted'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'MessageLog', fields ['when_attempted']
+        db.delete_index('mailer_messagelog', ['when_attempted'])
+
+        # Deleting field 'Message.subject'
+        db.delete_column('mailer_message', 'subject')
+
+        # Deleting field 'Message.to_addresses'
+        db.delete_column('mailer_message', 'to_addresses')
+
+        # Deleting field 'Message.from_address'
+        db.delete_column('mailer_message', 'from_address')
+
+        # Deleting field 'MessageLog.subject'
+        db.delete_column('mailer_messagelog', 'subject')
+
+        # Deleting field 'MessageLog.to_addresses'
+        db.delete_column('mailer_messagelog', 'to_addresses')
+
+        # Deleting field 'MessageLog.from_address'
+        db.delete_column('mailer_messagelog', 'from_address')
+
+
+    models = {
+        'mailer.connectionprofile': {
+            'Meta': {'object_name': 'ConnectionProfile'},
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {}),
+            'data_hash': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.dontsendentry': {
+            'Meta': {'object_name': 'DontSendEntry'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'to_address': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.message': {
+            'Meta': {'object_name': 'Message'},
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'connection_profile': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['mailer.ConnectionProfile']", 'null': 'True', 'blank': 'True'}),
+            'from_address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lease_expires': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'lease_owner': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '128', 'db_index': 'True', 'blank': 'True'}),
+            'message_blob': ('mailer.fields.BlobField', [], {'null': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'priority': ('django.db.models.fields.CharField', [], {'default': "'2'", 'max_length': '1'}),
+            'subject': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'to_addresses': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.messagelog': {
+            'Meta': {'object_name': 'MessageLog'},
+            'from_address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log_message': ('django.db.models.fields.TextField', [], {}),
+            'message_blob': ('mailer.fields.BlobField', [], {'null': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'priority': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'result': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'subject': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'to_addresses': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'when_attempted': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['mailer']
\ No newline at end of file
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import base64
+import datetime
+import pickle
+import zlib
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+
+# The storage formats and columns as they were when this migration was
+# written, so that later changes to mailer.models do not change what it does.
+
+def decode_data(data):
+    try:
+        return pickle.loads(base64.decodestring(data))
+    except Exception:
+        try:
+            return pickle.loads(data.encode("ascii"))
+        except Exception:
+            return None
+
+def decode_blob(data):
+    header, data = data[0], data[1:]
+    if header == "\x01":
+        return pickle.loads(data)
+    elif header == "\x02":
+        return pickle.loads(zlib.decompress(data))
+    raise ValueError("unknown message data format %r" % header)
+
+def email_fields(email):
+    return {
+        "subject": (email.subject or "")[:255],
+        "to_addresses": u", ".join(email.to)[:255],
+        "from_address": (email.from_email or "")[:255],
+    }
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        # Copy subject and addresses out of the pickled messages into the new
+        # columns, a chunk of rows at a time.
+        for model in (orm.Message, orm.MessageLog):
+            last_pk = 0
+            while True:
+                rows = list(model.objects.filter(pk__gt=last_pk).order_by("pk")
+                            .values_list("pk", "message_blob", "message_data")[:500])
+                if not rows:
+                    break
+                for pk, blob, data in rows:
+                    if blob:
+                        email = decode_blob(str(blob))
+                    elif data:
+                        email = decode_data(data)
+                    else:
+                        email = None
+                    if email is not None:
+                        model.objects.filter(pk=pk).update(**email_fields(email))
+                last_pk = rows[-1][0]
+
+    def backwards(self, orm):
+        # The columns are dropped by the previous migration.
+        pass
+
+    models = {
+        'mailer.connectionprofile': {
+            'Meta': {'object_name': 'ConnectionProfile'},
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {}),
+            'data_hash': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.dontsendentry': {
+            'Meta': {'object_name': 'DontSendEntry'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'to_address': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.message': {
+            'Meta': {'object_name': 'Message'},
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'connection_profile': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['mailer.ConnectionProfile']", 'null': 'True', 'blank': 'True'}),
+            'from_address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lease_expires': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'lease_owner': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '128', 'db_index': 'True', 'blank': 'True'}),
+            'message_blob': ('mailer.fields.BlobField', [], {'null': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'priority': ('django.db.models.fields.CharField', [], {'default': "'2'", 'max_length': '1'}),
+            'subject': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'to_addresses': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.messagelog': {
+            'Meta': {'object_name': 'MessageLog'},
+            'from_address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log_message': ('django.db.models.fields.TextField', [], {}),
+            'message_blob': ('mailer.fields.BlobField', [], {'null': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'priority': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'result': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'subject': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'to_addresses': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'when_attempted': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['mailer']
+    symmetrical = True
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import base64
+import datetime
+import pickle
+import uuid
+import zlib
+from email.utils import parseaddr
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+
+# The storage formats and columns as they were when this migration was
+# written, so that later changes to mailer.models do not change what it does.
+
+def decode_data(data):
+    try:
+        return pickle.loads(base64.decodestring(data))
+    except Exception:
+        try:
+            return pickle.loads(data.encode("ascii"))
+        except Exception:
+            return None
+
+def decode_blob(data):
+    header, data = data[0], data[1:]
+    if header == "\x01":
+        return pickle.loads(data)
+    elif header == "\x02":
+        return pickle.loads(zlib.decompress(data))
+    raise ValueError("unknown message data format %r" % header)
+
+def recipient_addresses(email):
+    addresses = set()
+    for address in email.recipients():
+        address = (parseaddr(address)[1] or address).strip().lower()[:255]
+        if address:
+            addresses.add(address)
+    return sorted(addresses)
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        # Give the rows already there a recipient_key and their Recipient
+        # rows, a chunk of rows at a time. A message and its log entries
+        # cannot be matched up, so each gets its own key.
+        for model in (orm.Message, orm.MessageLog):
+            last_pk = 0
+            while True:
+                rows = list(model.objects.filter(pk__gt=last_pk).order_by("pk")
+                            .values_list("pk", "message_blob", "message_data")[:500])
+                if not rows:
+                    break
+                recipients = []
+                for pk, blob, data in rows:
+                    if blob:
+                        email = decode_blob(str(blob))
+                    elif data:
+                        email = decode_data(data)
+                    else:
+                        email = None
+                    if email is not None:
+                        key = uuid.uuid4().hex
+                        model.objects.filter(pk=pk).update(recipient_key=key)
+                        recipients.extend(orm.Recipient(key=key, address=address)
+                                          for address in recipient_addresses(email))
+                if hasattr(orm.Recipient.objects, "bulk_create"):
+                    orm.Recipient.objects.bulk_create(recipients)
+                else:
+                    for recipient in recipients:
+                        recipient.save()
+                last_pk = rows[-1][0]
+
+    def backwards(self, orm):
+        # The table and columns are dropped by the previous migration.
+        pass
+
+    models = {
+        'mailer.attachment': {
+            'Meta': {'object_name': 'Attachment'},
+            'data': ('mailer.fields.BlobField', [], {}),
+            'digest': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'path': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'refcount': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'size': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.connectionprofile': {
+            'Meta': {'object_name': 'ConnectionProfile'},
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {}),
+            'data_hash': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '40'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.dontsendentry': {
+            'Meta': {'object_name': 'DontSendEntry'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'normalized_address': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'to_address': ('django.db.models.fields.EmailField', [], {'max_length': '75'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.lock': {
+            'Meta': {'object_name': 'Lock'},
+            'expires': ('django.db.models.fields.DateTimeField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100'}),
+            'owner': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        'mailer.message': {
+            'Meta': {'object_name': 'Message'},
+            'attachment_digests': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'connection_kwargs_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'connection_profile': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['mailer.ConnectionProfile']", 'null': 'True', 'blank': 'True'}),
+            'from_address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lease_expires': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'lease_owner': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '128', 'db_index': 'True', 'blank': 'True'}),
+            'message_blob': ('mailer.fields.BlobField', [], {'null': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'next_attempt_at': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True', 'null': 'True', 'blank': 'True'}),
+            'priority': ('django.db.models.fields.CharField', [], {'default': "'2'", 'max_length': '1'}),
+            'recipient_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'db_index': 'True', 'blank': 'True'}),
+            'subject': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'to_addresses': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'})
+        },
+        'mailer.messagelog': {
+            'Meta': {'object_name': 'MessageLog'},
+            'attachment_digests': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'from_address': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log_message': ('django.db.models.fields.TextField', [], {}),
+            'message_blob': ('mailer.fields.BlobField', [], {'null': 'True', 'blank': 'True'}),
+            'message_data': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'priority': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'recipient_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32', 'db_index': 'True', 'blank': 'True'}),
+            'result': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'subject': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'to_addresses': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'when_added': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'when_attempted': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        'mailer.recipient': {
+            'Meta': {'object_name': 'Recipient'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '255', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['mailer']
+    symmetrical = True
@@ -1,11 +1,67 @@
 import base64
+import copy
+import hashlib
 import logging
 import pickle
+import random
+import threading
+import time
+import uuid
+import zlib
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from email.utils import parseaddr
 
-from django.core.mail import EmailMessage
-from django.db import models
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import request_finished
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.db import models, connections, router, transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.signals import post_save, post_delete
+
+from mailer.fields import BlobField
+from mailer.files import FileAttachment, attach_file, file_attachments, get_storage
+from mailer.notify import notify_on_commit, flush as flush_notifications
+from mailer.prerender import PrerenderedEmail
+
+
+# whether to claim messages with SELECT ... FOR UPDATE SKIP LOCKED. the default
+# of None enables it on backends known to support it (PostgreSQL 9.5+).
+SKIP_LOCKED = getattr(settings, "MAILER_SKIP_LOCKED", None)
+
+# pickled messages larger than this many bytes are stored zlib-compressed.
+COMPRESS_THRESHOLD = getattr(settings, "MAILER_COMPRESS_THRESHOLD", 1024)
+
+# keep the whole don't send list in memory instead of querying it for every
+# message queued.
+DONT_SEND_CACHE = getattr(settings, "MAILER_DONT_SEND_CACHE", False)
+
+# how often (in seconds) the in-memory don't send list is reloaded, to pick
+# up changes made by other processes. changes made in this process are seen
+# immediately.
+DONT_SEND_CACHE_TTL = getattr(settings, "MAILER_DONT_SEND_CACHE_TTL", 60)
+
+# how long (in seconds) to wait before retrying a message deferred once. the
+# wait doubles with each further failure, up to RETRY_MAX_BACKOFF, and a
+# random part of up to half of it is taken off so retries spread out.
+RETRY_BACKOFF = getattr(settings, "MAILER_RETRY_BACKOFF", 60)
+RETRY_MAX_BACKOFF = getattr(settings, "MAILER_RETRY_MAX_BACKOFF", 6 * 60 * 60)
+
+# how many messages MessageManager.enqueue_many() writes per INSERT.
+ENQUEUE_CHUNK_SIZE = getattr(settings, "MAILER_ENQUEUE_CHUNK_SIZE", 500)
+
+# whether to render messages to their final text when they are queued, so
+# the sender only has to write out bytes (see mailer.prerender).
+PRERENDER = getattr(settings, "MAILER_PRERENDER", False)
+
+# attachments of at least this many bytes are stored once, by the SHA-256 of
+# their content, and shared by every message and log entry that has them.
+# None keeps every attachment inside its message.
+ATTACHMENT_STORE_THRESHOLD = getattr(settings, "MAILER_ATTACHMENT_STORE_THRESHOLD", 16 * 1024)
+
+# how many bytes of stored attachments each process keeps in memory.
+ATTACHMENT_CACHE_SIZE = getattr(settings, "MAILER_ATTACHMENT_CACHE_SIZE", 32 * 1024 * 1024)
 
 
 PRIORITIES = (
@@ -18,6 +74,14 @@ PRIORITIES = (
 
 class MessageManager(models.Manager):
     
+    def sent_to(self, address):
+        """
+        the messages in the queue addressed to the given address, whether in
+        To, Cc or Bcc
+        """
+        
+        return self.filter(recipient_key__in=Recipient.objects.keys_for(address))
+    
     def high_priority(self):
         """
         the high priority messages in the queue
@@ -53,12 +117,290 @@ class MessageManager(models.Manager):
     
         return self.filter(priority="4")
     
-    def retry_deferred(self, new_priority=2):
-        count = 0
-        for message in self.deferred():
-            if message.retry(new_priority):
-                count += 1
+    def available(self, now=None):
+        """
+        the messages in the queue not deferred, due to be sent and not leased
+        to a worker
+        """
+        
+        if now is None:
+            now = datetime.now()
+        return self.due(now).filter(priority__lt="4").filter(
+            Q(lease_expires__isnull=True) | Q(lease_expires__lt=now))
+    
+    def due(self, now=None):
+        """
+        the messages in the queue whose next attempt is not scheduled for
+        later
+        """
+        
+        if now is None:
+            now = datetime.now()
+        return self.filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+    
+    def leased(self, now=None):
+        """
+        the messages in the queue currently leased to a worker
+        """
+        
+        if now is None:
+            now = datetime.now()
+        return self.filter(lease_expires__gte=now)
+    
+    def claim(self, owner, limit, lease_seconds):
+        """
+        lease up to limit available messages to owner for lease_seconds and
+        return them in the order they should be sent. messages leased by
+        another owner are skipped until that lease expires.
+        """
+        
+        now = datetime.now()
+        expires = now + timedelta(seconds=lease_seconds)
+        if self._can_skip_locked():
+            ids = self._claim_skip_locked(owner, limit, now, expires)
+        else:
+            # the availability check is repeated in the UPDATE, so if two
+            # workers pick the same candidates each row goes to only one. the
+            # loser tries again rather than taking the queue for empty.
+            while True:
+                ids = list(self.available(now).order_by(
+                    "priority", "when_added").values_list("id", flat=True)[:limit])
+                if not ids or self.available(now).filter(id__in=ids).update(
+                        lease_owner=owner, lease_expires=expires):
+                    break
+        if not ids:
+            return []
+        return list(self.filter(id__in=ids, lease_owner=owner).order_by(
+            "priority", "when_added"))
+    
+    def renew(self, owner, ids, lease_seconds):
+        """
+        extend the lease on the given messages and return the set of ids
+        still held by owner
+        """
+        
+        expires = datetime.now() + timedelta(seconds=lease_seconds)
+        queryset = self.filter(id__in=ids, lease_owner=owner)
+        queryset.update(lease_expires=expires)
+        return set(queryset.values_list("id", flat=True))
+    
+    def release(self, owner):
+        """
+        give up any leases held by owner so other workers can claim them
+        """
+        
+        return self.filter(lease_owner=owner).update(
+            lease_owner="", lease_expires=None)
+    
+    def _can_skip_locked(self):
+        if SKIP_LOCKED is not None:
+            return SKIP_LOCKED
+        connection = connections[self.db]
+        return (getattr(connection, "vendor", None) == "postgresql" and
+                getattr(connection, "pg_version", 0) >= 90500)
+    
+    def _claim_skip_locked(self, owner, limit, now, expires):
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %(table)s SET lease_owner = %%s, lease_expires = %%s "
+            "WHERE id IN (SELECT id FROM %(table)s "
+            "WHERE priority < %%s "
+            "AND (lease_expires IS NULL OR lease_expires < %%s) "
+            "AND (next_attempt_at IS NULL OR next_attempt_at <= %%s) "
+            "ORDER BY priority, when_added LIMIT %%s "
+            "FOR UPDATE SKIP LOCKED) RETURNING id" % {"table": table},
+            [owner, expires, "4", now, now, limit])
+        ids = [row[0] for row in cursor.fetchall()]
+        transaction.commit_unless_managed(using=self.db)
+        return ids
+    
+    def enqueue_many(self, emails, priority="2", connection_kwargs=None, chunk_size=None):
+        """
+        queue the given EmailMessages in one transaction, inserting them
+        chunk_size at a time, and return how many were queued. recipients on
+        the don't send list are dropped first, along with any message left
+        without recipients.
+        """
+        
+        # not commit_on_success, which would commit a transaction the caller
+        # has under way
+        using = router.db_for_write(self.model)
+        try:
+            count = atomically(using, self._enqueue_many, emails, priority,
+                               connection_kwargs, chunk_size)
+        finally:
+            # deletes the files stored for it if it was rolled back
+            settle_files(using)
+        if count:
+            # once committed, so a woken send_loop() can see the messages
+            notify_on_commit(self.db)
         return count
+    
+    def _enqueue_many(self, emails, priority, connection_kwargs, chunk_size):
+        if chunk_size is None:
+            chunk_size = ENQUEUE_CHUNK_SIZE
+        emails = list(emails)
+        recipients = set()
+        for email in emails:
+            recipients.update(email.recipients())
+        blocked = DontSendEntry.objects.on_list(recipients)
+        profile = ConnectionProfile.objects.for_kwargs(connection_kwargs)
+        
+        messages = []
+        for email in emails:
+            email = copy.copy(email)
+            for name in ("to", "cc", "bcc"):
+                if getattr(email, name, None):
+                    setattr(email, name, filter_recipient_list(getattr(email, name), blocked))
+            if not email.recipients():
+                continue
+            message = self.model(priority=priority, connection_profile=profile)
+            message.email = email
+            messages.append(message)
+        
+        for i in range(0, len(messages), chunk_size):
+            chunk = messages[i:i + chunk_size]
+            # one UPDATE per distinct attachment in the chunk, however many
+            # messages share it
+            counts = {}
+            contents = {}
+            recipients = []
+            for message in chunk:
+                pending = message.__dict__.pop("_pending_attachments", None)
+                if pending is not None:
+                    contents.update(pending[0])
+                    add_counts(counts, message.attachment_digests)
+                pending = message.__dict__.pop("_pending_recipients", None)
+                if pending is not None:
+                    recipients.append((message.recipient_key, pending[0]))
+            if hasattr(self, "bulk_create"):
+                # Django 1.4
+                self.bulk_create(chunk)
+            else:
+                for message in chunk:
+                    message.save()
+            # after the messages, as in Message.save()
+            Attachment.objects.retain(counts, contents)
+            Recipient.objects.add_many(recipients)
+        return len(messages)
+    
+    def defer_many(self, messages):
+        """
+        defer the given messages, giving up any lease on them and scheduling
+        their next attempt. each message draws its own jitter, to the second,
+        and messages that come out the same are updated together.
+        """
+        
+        now = datetime.now()
+        groups = {}
+        for message in messages:
+            when = next_attempt_at(message.attempts + 1, now).replace(microsecond=0)
+            groups.setdefault((message.attempts, when), []).append(message.pk)
+        for (attempts, when), ids in groups.items():
+            self.filter(id__in=ids).update(
+                priority="4", lease_owner="", lease_expires=None,
+                attempts=attempts + 1, next_attempt_at=when)
+    
+    def delete_ids(self, ids):
+        """
+        delete the messages with the given ids with a single DELETE per 500.
+        unlike delete(), this does not release their stored attachments.
+        """
+        
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        cursor = connection.cursor()
+        ids = list(ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (table, ", ".join(["%s"] * len(chunk))), chunk)
+        transaction.commit_unless_managed(using=self.db)
+    
+    def retry_deferred(self, new_priority=2, limit=None):
+        """
+        move deferred messages whose next attempt is due back into the queue
+        with the given priority, at most limit of them if given, and return
+        how many were moved
+        """
+        
+        queryset = self.due().filter(priority="4")
+        if limit is not None:
+            ids = list(queryset.order_by("next_attempt_at").values_list("id", flat=True)[:limit])
+            queryset = self.filter(id__in=ids)
+        count = queryset.update(priority=new_priority)
+        if count:
+            notify_on_commit(self.db)
+        return count
+
+
+def next_attempt_at(attempts, now=None):
+    """
+    when to next try a message that has failed the given number of times
+    """
+    
+    if now is None:
+        now = datetime.now()
+    delay = min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** max(attempts - 1, 0))
+    return now + timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+# how to read the clock of the database server, by vendor. SQLite has no
+# server: the processes sharing its file share the host's clock.
+DATABASE_NOW = {
+    "postgresql": "SELECT CAST(clock_timestamp() AS timestamp)",
+    "mysql": "SELECT NOW()",
+    "oracle": "SELECT LOCALTIMESTAMP FROM DUAL",
+}
+
+
+def database_now(using):
+    """
+    The current time by the clock of the database using, so that hosts whose
+    clocks disagree still agree on it. The local time where it cannot be read.
+    """
+    
+    connection = connections[using]
+    sql = DATABASE_NOW.get(getattr(connection, "vendor", None))
+    if sql is None:
+        return datetime.now()
+    cursor = connection.cursor()
+    cursor.execute(sql)
+    return cursor.fetchone()[0]
+
+
+def atomically(using, func, *args, **kwargs):
+    """
+    Call func so that either all of its writes happen or none do: in a
+    transaction of its own, or in a savepoint if one is already under way
+    (a nested commit_on_success would commit the outer transaction early).
+    """
+    
+    managed = transaction.is_managed(using=using)
+    if managed:
+        sid = transaction.savepoint(using=using)
+    else:
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+    try:
+        try:
+            result = func(*args, **kwargs)
+        except:
+            if managed:
+                transaction.savepoint_rollback(sid, using=using)
+            else:
+                transaction.rollback(using=using)
+            raise
+        if managed:
+            transaction.savepoint_commit(sid, using=using)
+        else:
+            transaction.commit(using=using)
+        return result
+    finally:
+        if not managed:
+            transaction.leave_transaction_management(using=using)
 
 
 def email_to_db(email):
@@ -89,20 +431,569 @@ def db_to_object(data):
             except Exception:
                 return None
 
+
+# header bytes of the binary storage format
+BLOB_PICKLE = "\x01"
+BLOB_PICKLE_ZLIB = "\x02"
+
+
+def object_to_blob(thing):
+    """
+    Serialize thing for a BlobField: a header byte giving the format,
+    followed by the pickle, compressed if that makes it smaller.
+    """
+    
+    data = pickle.dumps(thing, pickle.HIGHEST_PROTOCOL)
+    if len(data) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return BLOB_PICKLE_ZLIB + compressed
+    return BLOB_PICKLE + data
+
+
+def blob_to_object(data):
+    if not data:
+        return None
+    header, data = data[0], data[1:]
+    if header == BLOB_PICKLE:
+        return pickle.loads(data)
+    elif header == BLOB_PICKLE_ZLIB:
+        return pickle.loads(zlib.decompress(data))
+    raise ValueError("unknown message data format %r" % header)
+
+
+def decode_email(instance):
+    """
+    The EmailMessage stored on a Message or MessageLog. It is decoded on first
+    use and reused for as long as the stored data stays the same.
+    """
+    
+    cache = instance.__dict__.get("_email_cache")
+    if (cache is None or cache[0] is not instance.message_blob or
+            cache[1] is not instance.message_data):
+        if instance.message_blob:
+            email = blob_to_object(instance.message_blob)
+        else:
+            email = db_to_object(instance.message_data)
+        if getattr(instance, "attachment_digests", ""):
+            pending = instance.__dict__.get("_pending_attachments")
+            restore_attachments(email, pending and pending[0])
+        cache = (instance.message_blob, instance.message_data, email)
+        instance._email_cache = cache
+    return cache[2]
+
+
+class MissingAttachment(Exception):
+    """
+    A message refers to stored attachments that are no longer in the
+    Attachment table. digests lists them.
+    """
+    
+    def __init__(self, digests):
+        Exception.__init__(self, "stored attachment missing: %s" % ", ".join(digests))
+        self.digests = digests
+
+
+class AttachmentRef(object):
+    """
+    Takes the place of the content of an attachment kept in the Attachment
+    table, inside the EmailMessage stored on a Message or MessageLog.
+    """
+    
+    def __init__(self, digest, size):
+        self.digest = digest
+        self.size = size
+    
+    def __repr__(self):
+        return "<AttachmentRef %s (%s bytes)>" % (self.digest, self.size)
+
+
+def store_attachments(email):
+    """
+    Split the attachments of at least ATTACHMENT_STORE_THRESHOLD bytes off
+    email. Returns a copy of email with AttachmentRefs in their place, a dict
+    of their content by digest and the list of digests, one per attachment.
+    Files copied into storage by attach_file() are counted too, by their key,
+    with the FileAttachment as their content.
+    """
+    
+    attachments = getattr(email, "attachments", None)
+    if not attachments:
+        return email, {}, []
+    contents = {}
+    digests = []
+    stored = []
+    replaced = False
+    for attachment in attachments:
+        if isinstance(attachment, FileAttachment):
+            if attachment.key:
+                contents[attachment.key] = attachment
+                digests.append(attachment.key)
+        # other MIMEBase attachments, and text given as unicode, are left in
+        # place
+        elif (ATTACHMENT_STORE_THRESHOLD is not None and
+                isinstance(attachment, tuple) and len(attachment) == 3):
+            filename, content, mimetype = attachment
+            if isinstance(content, str) and len(content) >= ATTACHMENT_STORE_THRESHOLD:
+                digest = hashlib.sha256(content).hexdigest()
+                contents[digest] = content
+                digests.append(digest)
+                attachment = (filename, AttachmentRef(digest, len(content)), mimetype)
+                replaced = True
+        stored.append(attachment)
+    if not replaced:
+        return email, contents, digests
+    email = copy.copy(email)
+    email.attachments = stored
+    return email, contents, digests
+
+
+def restore_attachments(email, known=None):
+    """
+    Put the content of stored attachments back into email, which is changed
+    in place. known may give content not yet in the Attachment table. Raises
+    MissingAttachment if any of them is gone.
+    """
+    
+    attachments = getattr(email, "attachments", None)
+    if not attachments:
+        return
+    digests = [a[1].digest for a in attachments
+               if isinstance(a, tuple) and len(a) == 3 and isinstance(a[1], AttachmentRef)]
+    if not digests:
+        return
+    contents = dict(known or {})
+    contents.update(Attachment.objects.contents([d for d in digests if d not in contents]))
+    missing = [d for d in digests if d not in contents]
+    if missing:
+        raise MissingAttachment(missing)
+    restored = []
+    for attachment in attachments:
+        if isinstance(attachment, tuple) and len(attachment) == 3 and isinstance(attachment[1], AttachmentRef):
+            filename, ref, mimetype = attachment
+            attachment = (filename, contents[ref.digest], mimetype)
+        restored.append(attachment)
+    email.attachments = restored
+
+
+def add_counts(counts, digests, sign=1):
+    """
+    Add the digests in the space-separated string digests to the dict
+    counts, each as many times as it appears.
+    """
+    
+    for digest in (digests or "").split():
+        counts[digest] = counts.get(digest, 0) + sign
+    return counts
+
+
+def email_fields(email):
+    """
+    The values of the subject, to_addresses and from_address columns for the
+    given EmailMessage, cut to fit. to_addresses holds the To addresses only.
+    """
+    
+    if email is None:
+        return {"subject": "", "to_addresses": "", "from_address": ""}
+    return {
+        "subject": (email.subject or "")[:255],
+        "to_addresses": u", ".join(email.to)[:255],
+        "from_address": (email.from_email or "")[:255],
+    }
+
+
+class ConnectionProfileManager(models.Manager):
+    
+    # profiles are cached, both by id and by data_hash, per database. saving
+    # or deleting one clears the cache of its database.
+    _cache = {}
+    
+    def for_kwargs(self, connection_kwargs):
+        """
+        the profile holding the given connection arguments, created if needed
+        """
+        
+        if not connection_kwargs:
+            return None
+        data_hash = hash_connection_kwargs(connection_kwargs)
+        profile = self._cache.get(self.db, {}).get(data_hash)
+        if profile is None:
+            profile, created = self.get_or_create(data_hash=data_hash, defaults={
+                "connection_kwargs_data": object_to_db(connection_kwargs),
+            })
+            if not created or not transaction.is_managed(using=self.db):
+                # one created in a transaction goes if that is rolled back
+                self._remember(profile)
+        return profile
+    
+    def get_cached(self, pk):
+        """
+        the profile with the given id, fetched from the database only once
+        """
+        
+        profile = self._cache.get(self.db, {}).get(pk)
+        if profile is None:
+            profile = self.get(pk=pk)
+            self._remember(profile)
+        return profile
+    
+    def invalidate_cache(self):
+        self._cache.pop(self.db, None)
+    
+    def _remember(self, profile):
+        cache = self._cache.setdefault(self.db, {})
+        cache[profile.pk] = profile
+        cache[profile.data_hash] = profile
+
+
+def hash_connection_kwargs(connection_kwargs):
+    return hashlib.sha1(repr(sorted(connection_kwargs.items()))).hexdigest()
+
+
+class ConnectionProfile(models.Model):
+    
+    # A set of connection arguments shared by every message sent with them.
+    # data_hash identifies the arguments so each set is stored only once.
+    data_hash = models.CharField(max_length=40, unique=True)
+    connection_kwargs_data = models.TextField()
+    when_added = models.DateTimeField(auto_now_add=True)
+    
+    objects = ConnectionProfileManager()
+    
+    @property
+    def connection_kwargs(self):
+        if not hasattr(self, "_connection_kwargs"):
+            self._connection_kwargs = db_to_object(self.connection_kwargs_data)
+        return self._connection_kwargs
+
+
+def invalidate_connection_profile_cache(sender, using=None, **kwargs):
+    ConnectionProfile.objects.db_manager(using).invalidate_cache()
+
+post_save.connect(invalidate_connection_profile_cache, sender=ConnectionProfile)
+post_delete.connect(invalidate_connection_profile_cache, sender=ConnectionProfile)
+
+
+# the paths of files stored or released by transactions that had not ended
+# when they were, by database, per thread. see settle_files().
+_unsettled = threading.local()
+
+
+def settle_files(using=None, **kwargs):
+    """
+    Delete the files stored or released on the database using (or on any)
+    that no attachment refers to once the transactions that did so have
+    ended: those released for good and those stored by an insert that was
+    rolled back. Databases still in a transaction are left for later. This
+    is done at the end of every request and whenever mail is saved outside a
+    transaction; code saving mail in transactions of its own outside a
+    request should call it once they have ended.
+    """
+    
+    pending = getattr(_unsettled, "paths", None)
+    if not pending:
+        return
+    for alias in [using] if using is not None else pending.keys():
+        if alias not in pending or transaction.is_managed(using=alias):
+            continue
+        paths = pending.pop(alias)
+        storage = get_storage()
+        for path in paths - set(Attachment.objects.db_manager(alias).filter(path__in=paths)
+                                .values_list("path", flat=True)):
+            storage.delete(path)
+
+request_finished.connect(settle_files)
+
+
+class AttachmentManager(models.Manager):
+    
+    # the content of recently loaded attachments by digest, the order they
+    # were loaded in and their total size. content never changes once stored.
+    _cache = {"contents": {}, "order": [], "size": 0}
+    _cache_lock = threading.Lock()
+    
+    def retain(self, counts, contents=None):
+        """
+        add counts[digest] references to each stored attachment, storing it
+        first from contents if it is not stored yet. raises MissingAttachment
+        for one that is neither stored nor in contents.
+        """
+        
+        for digest, count in counts.items():
+            while not self.filter(digest=digest).update(refcount=F("refcount") + count):
+                if contents is None or digest not in contents:
+                    raise MissingAttachment([digest])
+                if self._insert(digest, contents[digest], count):
+                    break
+                # stored by someone else in the meantime
+    
+    def _insert(self, digest, content, count):
+        if isinstance(content, FileAttachment):
+            # a file handle given to attach_file() is copied into storage now
+            content.store()
+            attachment = self.model(digest=digest, data="", path=content.path, size=content.size or 0)
+        else:
+            attachment = self.model(digest=digest, data=content, size=len(content))
+        attachment.refcount = count
+        sid = transaction.savepoint(using=self.db)
+        try:
+            try:
+                attachment.save(force_insert=True, using=self.db)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+                return False
+            transaction.savepoint_commit(sid, using=self.db)
+            return True
+        finally:
+            if attachment.path:
+                # deleted again if the row does not make it
+                self._settle_on_commit([attachment.path])
+    
+    def release(self, counts):
+        """
+        remove counts[digest] references from each stored attachment and
+        delete those no longer referenced
+        """
+        
+        counts = dict((digest, count) for digest, count in counts.items() if count)
+        if not counts:
+            return
+        for digest, count in counts.items():
+            self.filter(digest=digest).update(refcount=F("refcount") - count)
+        digests = list(counts)
+        paths = []
+        for i in range(0, len(digests), 500):
+            queryset = self.filter(digest__in=digests[i:i + 500], refcount__lte=0)
+            paths.extend(queryset.exclude(path="").values_list("path", flat=True))
+            queryset.delete()
+        transaction.commit_unless_managed(using=self.db)
+        if paths:
+            # unless referenced again in the meantime, or the rows come back
+            # with a rollback
+            self._settle_on_commit(paths)
+    
+    def _settle_on_commit(self, paths):
+        pending = getattr(_unsettled, "paths", None)
+        if pending is None:
+            pending = _unsettled.paths = {}
+        pending.setdefault(self.db, set()).update(paths)
+        settle_files(self.db)
+    
+    def adjust(self, counts):
+        """
+        retain the positive and release the negative counts
+        """
+        
+        self.retain(dict((d, c) for d, c in counts.items() if c > 0))
+        self.release(dict((d, -c) for d, c in counts.items() if c < 0))
+    
+    def contents(self, digests):
+        """
+        the content of the stored attachments with the given digests, by
+        digest, from memory where possible
+        """
+        
+        found = {}
+        missing = []
+        cached = self._cache["contents"]
+        for digest in set(digests):
+            content = cached.get(digest)
+            if content is None:
+                missing.append(digest)
+            else:
+                found[digest] = content
+        if missing:
+            loaded = dict((digest, str(data)) for digest, data in
+                          self.filter(digest__in=missing).values_list("digest", "data"))
+            found.update(loaded)
+            self._remember(loaded)
+        return found
+    
+    def _remember(self, loaded):
+        cache = self._cache
+        self._cache_lock.acquire()
+        try:
+            for digest, content in loaded.items():
+                if len(content) > ATTACHMENT_CACHE_SIZE or digest in cache["contents"]:
+                    continue
+                cache["contents"][digest] = content
+                cache["order"].append(digest)
+                cache["size"] += len(content)
+            while cache["size"] > ATTACHMENT_CACHE_SIZE:
+                # the first loaded goes first
+                content = cache["contents"].pop(cache["order"].pop(0))
+                cache["size"] -= len(content)
+        finally:
+            self._cache_lock.release()
+
+
+class Attachment(models.Model):
+    """
+    The content of an attachment shared by the messages and log entries that
+    list its digest in their attachment_digests. For a file copied into
+    storage by mailer.files.attach_file(), the digest is the file's key and
+    path is where it is, instead of data.
+    """
+    
+    digest = models.CharField(max_length=64, unique=True)
+    data = BlobField()
+    path = models.CharField(max_length=255, blank=True, default="")
+    size = models.PositiveIntegerField()
+    # how many messages and log entries reference it, counting a message
+    # that has it twice twice. it is deleted when this drops to zero.
+    refcount = models.IntegerField(default=0)
+    when_added = models.DateTimeField(auto_now_add=True)
+    
+    objects = AttachmentManager()
+
+
+def recipient_addresses(email):
+    """
+    The normalized addresses email is sent to, To, Cc and Bcc alike, each
+    once.
+    """
+    
+    if email is None:
+        return []
+    addresses = set()
+    for address in email.recipients():
+        address = normalize_address(parseaddr(address)[1] or address)[:255]
+        if address:
+            addresses.add(address)
+    return sorted(addresses)
+
+
+class RecipientManager(models.Manager):
+    
+    def add_many(self, recipients):
+        """
+        store the given (recipient_key, addresses) pairs with a single insert
+        """
+        
+        rows = [self.model(key=key, address=address)
+                for key, addresses in recipients for address in addresses]
+        if not rows:
+            return
+        if hasattr(self, "bulk_create"):
+            # Django 1.4
+            self.bulk_create(rows)
+        else:
+            for row in rows:
+                row.save(using=self.db)
+    
+    def keys_for(self, address):
+        """
+        the recipient_key values of the mail sent to the given address
+        """
+        
+        return self.filter(address=normalize_address(address)).values("key")
+    
+    def release(self, keys):
+        """
+        delete the recipients stored under the given keys that no message
+        or log entry refers to any more
+        """
+        
+        keys = set(key for key in keys if key)
+        if not keys:
+            return
+        keys -= set(Message.objects.filter(recipient_key__in=keys).values_list("recipient_key", flat=True))
+        keys -= set(MessageLog.objects.filter(recipient_key__in=keys).values_list("recipient_key", flat=True))
+        if keys:
+            self.filter(key__in=keys).delete()
+
+
+class Recipient(models.Model):
+    
+    # One row for each address a message is sent to, shared by the message
+    # and its log entries through their recipient_key, so that the mail sent
+    # to an address can be looked up with an index. rows are written with
+    # the message and deleted once nothing refers to their key.
+    key = models.CharField(max_length=32, db_index=True)
+    address = models.CharField(max_length=255, db_index=True)
+    
+    objects = RecipientManager()
+
+
 class Message(models.Model):
     
-    # The actual data - a pickled EmailMessage
-    message_data = models.TextField()
+    # The actual data - an EmailMessage serialized by object_to_blob
+    message_blob = BlobField(null=True, blank=True)
+    # The same, base64-pickled as stored by older versions. New messages use
+    # message_blob and leave this empty; see the compact_message_data command.
+    message_data = models.TextField(blank=True, default="")
+    # Copied from the EmailMessage whenever it is set, see email_fields().
+    # to_addresses is for display only: it leaves out cc and bcc and is cut
+    # to 255 characters. To find mail by recipient use
+    # objects.sent_to(), which looks in the Recipient table.
+    subject = models.CharField(max_length=255, blank=True, default="")
+    to_addresses = models.CharField(max_length=255, blank=True, default="")
+    from_address = models.CharField(max_length=255, blank=True, default="", db_index=True)
+    # Identifies the Recipient rows of the email, set anew whenever it is set
+    recipient_key = models.CharField(max_length=32, blank=True, default="", db_index=True)
     when_added = models.DateTimeField(auto_now_add=True)
     priority = models.CharField(max_length=1, choices=PRIORITIES, default="2")
-    connection_kwargs_data = models.TextField()
+    connection_profile = models.ForeignKey(ConnectionProfile, null=True, blank=True)
+    # Connection arguments stored on the message itself by older versions.
+    # New messages use connection_profile and leave this empty.
+    connection_kwargs_data = models.TextField(blank=True, default="")
+    # The worker currently sending this message, and until when it may do so.
+    # A message whose lease has expired can be claimed by another worker.
+    lease_owner = models.CharField(max_length=128, blank=True, default="", db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    # How often sending has failed, and when it may next be tried.
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # The digests of the attachments kept in the Attachment table, separated
+    # by spaces, see store_attachments()
+    attachment_digests = models.TextField(blank=True, default="")
     # @@@ campaign?
     # @@@ content_type?
     
     objects = MessageManager()
     
+    def save(self, *args, **kwargs):
+        # both are set whenever the email is
+        pending = self.__dict__.pop("_pending_attachments", None)
+        recipients = self.__dict__.pop("_pending_recipients", None)
+        if pending is None:
+            return super(Message, self).save(*args, **kwargs)
+        using = kwargs.get("using") or router.db_for_write(Message, instance=self)
+        managed = transaction.is_managed(using=using)
+        try:
+            atomically(using, self._save_email, pending, recipients, args, kwargs)
+        except:
+            # nothing was written, so the next save() has to do it all
+            self._pending_attachments = pending
+            self._pending_recipients = recipients
+            if not managed:
+                settle_files(using)
+            raise
+        if not managed:
+            # the transaction notify_queued() saw has been committed
+            flush_notifications(using)
+            settle_files(using)
+    
+    def _save_email(self, pending, recipients, args, kwargs):
+        # the row is written first, so a save that fails leaves no references
+        # behind even where savepoints are not supported. retain() stores an
+        # attachment again if it was deleted in the meantime.
+        super(Message, self).save(*args, **kwargs)
+        attachments = Attachment.objects.db_manager(kwargs.get("using"))
+        attachments.retain(add_counts({}, self.attachment_digests), pending[0])
+        if pending[1]:
+            attachments.release(add_counts({}, pending[1]))
+        if recipients is not None:
+            addresses, replaced_key = recipients
+            Recipient.objects.db_manager(kwargs.get("using")).add_many([(self.recipient_key, addresses)])
+            Recipient.objects.db_manager(kwargs.get("using")).release([replaced_key])
+    
     def defer(self):
         self.priority = "4"
+        self.lease_owner = ""
+        self.lease_expires = None
+        self.attempts += 1
+        self.next_attempt_at = next_attempt_at(self.attempts)
         self.save()
     
     def retry(self, new_priority=2):
@@ -114,20 +1005,57 @@ class Message(models.Model):
             return False
     
     def _get_email(self):
-        return db_to_object(self.message_data)
+        return decode_email(self)
     
     def _set_email(self, val):
-        self.message_data = object_to_db(val)
+        if (PRERENDER and val is not None and not isinstance(val, PrerenderedEmail)
+                and not file_attachments(val)):
+            # files are left out of line rather than rendered into the text
+            val = PrerenderedEmail(val)
+        stored, contents, digests = store_attachments(val)
+        pending = self.__dict__.get("_pending_attachments")
+        if pending is not None:
+            # still referencing what the row in the database does
+            released = pending[1]
+        elif self.pk is not None:
+            released = self.attachment_digests
+        else:
+            released = ""
+        self._pending_attachments = (contents, released)
+        self.attachment_digests = " ".join(digests)
+        pending = self.__dict__.get("_pending_recipients")
+        if pending is not None:
+            replaced_key = pending[1]
+        elif self.pk is not None:
+            replaced_key = self.recipient_key
+        else:
+            replaced_key = ""
+        self.recipient_key = uuid.uuid4().hex
+        self._pending_recipients = (recipient_addresses(val), replaced_key)
+        self.message_blob = object_to_blob(stored)
+        self.message_data = ""
+        self._email_cache = None
+        for name, value in email_fields(val).items():
+            setattr(self, name, value)
 
     email = property(_get_email, _set_email, doc=
                      """EmailMessage object. If this is mutated, you will need to
-set the attribute again to cause the underlying serialised data to be updated.""")
+set the attribute again to cause the underlying serialised data to be updated.
+It is decoded once and then reused until the serialised data changes.""")
     
     def _get_connection_kwargs(self):
-        return db_to_object(self.connection_kwargs_data)
+        if self.connection_profile_id is not None:
+            return ConnectionProfile.objects.get_cached(self.connection_profile_id).connection_kwargs
+        cache = self.__dict__.get("_connection_kwargs_cache")
+        if cache is None or cache[0] is not self.connection_kwargs_data:
+            cache = (self.connection_kwargs_data, db_to_object(self.connection_kwargs_data))
+            self._connection_kwargs_cache = cache
+        return cache[1]
     
     def _set_connection_kwargs(self, val):
-        self.connection_kwargs_data = object_to_db(val)
+        self.connection_profile = ConnectionProfile.objects.for_kwargs(val)
+        self.connection_kwargs_data = ""
+        self._connection_kwargs_cache = None
 
     connection_kwargs = property(_get_connection_kwargs, _set_connection_kwargs, doc=
                      """Array of Tuples, used for creating a e-mail connection to 
@@ -135,28 +1063,15 @@ a backend. If this is mutated, you will need to
 set the attribute again to cause the underlying serialised data to be updated.""")
     
     @property
-    def from_address(self):
-        email = self.email
-        if email is not None:
-            return email.from_email
-        else:
-            return []
-    
-    @property
-    def to_addresses(self):
-        email = self.email
-        if email is not None:
-            return u", ".join(email.to)
-        else:
-            return []
-    
-    @property
-    def subject(self):
-        email = self.email
-        if email is not None:
-            return email.subject
-        else:
-            return ""
+    def connection_key(self):
+        """
+        A hashable value that is equal for messages sent with the same
+        connection arguments.
+        """
+        
+        if self.connection_profile_id is not None:
+            return self.connection_profile_id
+        return tuple(sorted((self.connection_kwargs or {}).items()))
     
     @property
     def body(self):
@@ -177,12 +1092,33 @@ set the attribute again to cause the underlying serialised data to be updated.""
             return ""
 
 
-def filter_recipient_list(lst):
+def notify_queued(sender, instance, created=False, **kwargs):
+    if created:
+        notify_on_commit(instance._state.db)
+
+post_save.connect(notify_queued, sender=Message)
+
+
+def release_attachments(sender, instance, **kwargs):
+    if instance.attachment_digests:
+        Attachment.objects.release(add_counts({}, instance.attachment_digests))
+    Recipient.objects.release([instance.recipient_key])
+
+post_delete.connect(release_attachments, sender=Message)
+
+
+def filter_recipient_list(lst, blocked=None):
+    """
+    The addresses in lst that are not on the don't send list. blocked may
+    give the result of DontSendEntry.objects.on_list() for them, if known.
+    """
     if lst is None:
         return None
+    if blocked is None:
+        blocked = DontSendEntry.objects.on_list(lst)
     retval = []
     for e in lst:
-        if DontSendEntry.objects.has_address(e):
+        if normalize_address(e) in blocked:
             logging.info("skipping email to %s as on don't send list " % e.encode("utf-8"))
         else:
             retval.append(e)
@@ -191,20 +1127,34 @@ def filter_recipient_list(lst):
 
 def make_message(subject="", body="", from_email=None, to=None, bcc=None,
                  attachments=None, headers=None, priority=None, db_msg=None,
-                 connection_kwargs=None):
+                 connection_kwargs=None, alternatives=None):
     """
     Creates a simple message for the email parameters supplied.
     The 'to' and 'bcc' lists are filtered using DontSendEntry.
     
     If needed, the 'email' attribute can be set to any instance of EmailMessage
-    if e-mails with attachments etc. need to be supported.
+    if e-mails with attachments etc. need to be supported. If alternatives
+    are given, as (content, mimetype) pairs, it is an EmailMultiAlternatives.
+    
+    An attachment given as (filename, content, mimetype) with a file handle
+    as its content is copied into file storage and read from there when the
+    message is sent, see mailer.files.
     
     Call 'save()' on the result when it is ready to be sent, and not before.
     """
     to = filter_recipient_list(to)
     bcc = filter_recipient_list(bcc)
-    core_msg = EmailMessage(subject=subject, body=body, from_email=from_email,
-                            to=to, bcc=bcc, attachments=attachments, headers=headers)
+    if attachments:
+        attachments = [attach_file(a[1], a[0], a[2])
+                       if isinstance(a, tuple) and len(a) == 3 and hasattr(a[1], "read") else a
+                       for a in attachments]
+    if alternatives:
+        core_msg = EmailMultiAlternatives(subject=subject, body=body, from_email=from_email,
+                                          to=to, bcc=bcc, attachments=attachments, headers=headers,
+                                          alternatives=alternatives)
+    else:
+        core_msg = EmailMessage(subject=subject, body=body, from_email=from_email,
+                                to=to, bcc=bcc, attachments=attachments, headers=headers)
     
     if not db_msg:
         db_msg = Message(priority=priority)
@@ -213,25 +1163,90 @@ def make_message(subject="", body="", from_email=None, to=None, bcc=None,
     return db_msg
 
 
+def normalize_address(address):
+    return address.strip().lower()
+
+
+def suppression_keys(address):
+    """
+    the normalized_address values of the entries that would suppress mail to
+    the given address: the address itself and a wildcard for its domain
+    """
+    
+    address = normalize_address(address)
+    keys = [address]
+    if "@" in address:
+        keys.append("*@" + address.rsplit("@", 1)[1])
+    return keys
+
+
 class DontSendEntryManager(models.Manager):
     
+    # the normalized addresses on the list when DONT_SEND_CACHE is on, and
+    # when they were loaded
+    _cache = {"addresses": None, "loaded": 0}
+    
     def has_address(self, address):
         """
-        is the given address on the don't send list?
+        is the given address on the don't send list, either itself or by its
+        domain?
         """
         
-        queryset = self.filter(to_address__iexact=address)
+        if DONT_SEND_CACHE:
+            return bool(self.on_list([address]))
+        queryset = self.filter(normalized_address__in=suppression_keys(address))
         try:
             # Django 1.2
             return queryset.exists()
         except AttributeError:
             # AttributeError: 'QuerySet' object has no attribute 'exists'
             return bool(queryset.count())
+    
+    def on_list(self, addresses):
+        """
+        the given addresses that are on the don't send list, lowercased
+        """
+        
+        keys = dict((normalize_address(address), suppression_keys(address))
+                    for address in addresses)
+        if not keys:
+            return set()
+        if DONT_SEND_CACHE:
+            found = self.cached_addresses()
+        else:
+            wanted = list(set(key for address_keys in keys.values() for key in address_keys))
+            found = set()
+            # in chunks to stay under the databases' limits on query parameters
+            for i in range(0, len(wanted), 500):
+                found.update(self.filter(normalized_address__in=wanted[i:i + 500])
+                             .values_list("normalized_address", flat=True))
+        return set(address for address, address_keys in keys.items()
+                   if any(key in found for key in address_keys))
+    
+    def cached_addresses(self):
+        """
+        the set of normalized addresses on the don't send list, reloaded
+        every DONT_SEND_CACHE_TTL seconds. no cheaper check can tell whether
+        an entry was edited in place, so it is not attempted.
+        """
+        
+        cache = self._cache
+        now = time.time()
+        if cache["addresses"] is None or now - cache["loaded"] > DONT_SEND_CACHE_TTL:
+            cache["addresses"] = set(self.values_list("normalized_address", flat=True).iterator())
+            cache["loaded"] = now
+        return cache["addresses"]
+    
+    def invalidate_cache(self):
+        self._cache["addresses"] = None
 
 
 class DontSendEntry(models.Model):
     
+    # an address, or "*@example.com" to suppress a whole domain
     to_address = models.EmailField()
+    # to_address as normalize_address() has it, for indexed lookups
+    normalized_address = models.CharField(max_length=255, unique=True, editable=False)
     when_added = models.DateTimeField(auto_now_add=True)
     # @@@ who added?
     # @@@ comment field?
@@ -241,6 +1256,23 @@ class DontSendEntry(models.Model):
     class Meta:
         verbose_name = "don't send entry"
         verbose_name_plural = "don't send entries"
+    
+    def clean(self):
+        duplicates = DontSendEntry.objects.filter(
+            normalized_address=normalize_address(self.to_address)).exclude(pk=self.pk)
+        if duplicates.exists():
+            raise ValidationError("%s is already on the don't send list." % self.to_address)
+    
+    def save(self, *args, **kwargs):
+        self.normalized_address = normalize_address(self.to_address)
+        super(DontSendEntry, self).save(*args, **kwargs)
+
+
+def invalidate_dont_send_cache(sender, **kwargs):
+    DontSendEntry.objects.invalidate_cache()
+
+post_save.connect(invalidate_dont_send_cache, sender=DontSendEntry)
+post_delete.connect(invalidate_dont_send_cache, sender=DontSendEntry)
 
 
 RESULT_CODES = (
@@ -253,14 +1285,44 @@ RESULT_CODES = (
 
 class MessageLogManager(models.Manager):
     
-    def log(self, message, result_code, log_message=""):
+    def sent_to(self, address):
+        """
+        the log entries of the messages addressed to the given address,
+        whether in To, Cc or Bcc
+        """
+        
+        return self.filter(recipient_key__in=Recipient.objects.keys_for(address))
+    
+    def log(self, message, result_code, log_message="", error=None):
         """
         create a log entry for an attempt to send the given message and
-        record the given result and (optionally) a log message
+        record the given result and (optionally) a log message and the error
+        the attempt failed with
+        """
+        
+        entry = self.make_entry(message, result_code, log_message, error)
+        Attachment.objects.retain(add_counts({}, entry.attachment_digests))
+        entry.save(force_insert=True, using=self.db)
+        return entry
+    
+    def make_entry(self, message, result_code, log_message="", error=None):
+        """
+        the unsaved log entry that log() would create. if the attempt failed
+        with MissingAttachment, the entry does not refer to the attachments
+        that are gone.
         """
         
-        return self.create(
+        digests = message.attachment_digests
+        if isinstance(error, MissingAttachment):
+            digests = " ".join(d for d in digests.split() if d not in error.digests)
+        return self.model(
+            message_blob = message.message_blob,
             message_data = message.message_data,
+            attachment_digests = digests,
+            subject = message.subject,
+            to_addresses = message.to_addresses,
+            from_address = message.from_address,
+            recipient_key = message.recipient_key,
             when_added = message.when_added,
             priority = message.priority,
             # @@@ other fields from Message
@@ -272,13 +1334,20 @@ class MessageLogManager(models.Manager):
 class MessageLog(models.Model):
     
     # fields from Message
-    message_data = models.TextField()
+    message_blob = BlobField(null=True, blank=True)
+    message_data = models.TextField(blank=True, default="")
+    attachment_digests = models.TextField(blank=True, default="")
+    # as on Message
+    subject = models.CharField(max_length=255, blank=True, default="")
+    to_addresses = models.CharField(max_length=255, blank=True, default="")
+    from_address = models.CharField(max_length=255, blank=True, default="", db_index=True)
+    recipient_key = models.CharField(max_length=32, blank=True, default="", db_index=True)
     when_added = models.DateTimeField(auto_now_add=True)
     priority = models.CharField(max_length=1, choices=PRIORITIES)
     # @@@ campaign?
     
     # additional logging fields
-    when_attempted = models.DateTimeField(auto_now=True)
+    when_attempted = models.DateTimeField(auto_now=True, db_index=True)
     result = models.CharField(max_length=1, choices=RESULT_CODES)
     log_message = models.TextField()
     
@@ -286,20 +1355,77 @@ class MessageLog(models.Model):
     
     @property
     def email(self):
-        return db_to_object(self.message_data)
+        return decode_email(self)
+
+post_delete.connect(release_attachments, sender=MessageLog)
+
+
+class LockManager(models.Manager):
     
-    @property
-    def to_addresses(self):
-        email = self.email
-        if email is not None:
-            return u", ".join(email.to)
-        else:
-            return []
+    def acquire(self, name, owner, ttl):
+        """
+        take the lock with the given name for owner for ttl seconds, unless
+        another owner holds it and has not let it expire. returns whether it
+        was taken.
+        """
+        
+        # by the database's clock, which every host reads the same
+        now = database_now(self.db)
+        expires = now + timedelta(seconds=ttl)
+        if self.filter(name=name).filter(Q(owner=owner) | Q(expires__lt=now)).update(
+                owner=owner, expires=expires):
+            return True
+        try:
+            self._insert(name, owner, expires)
+        except IntegrityError:
+            # someone else holds it
+            return False
+        return True
     
-    @property
-    def subject(self):
-        email = self.email
-        if email is not None:
-            return email.subject
-        else:
-            return ""
+    @transaction.commit_on_success
+    def _insert(self, name, owner, expires):
+        self.model(name=name, owner=owner, expires=expires).save(force_insert=True, using=self.db)
+    
+    def renew(self, name, owner, ttl):
+        """
+        extend owner's hold on the lock with the given name by ttl seconds.
+        returns False if owner no longer holds it.
+        """
+        
+        expires = database_now(self.db) + timedelta(seconds=ttl)
+        return bool(self.filter(name=name, owner=owner).update(expires=expires))
+    
+    def release(self, name, owner):
+        """
+        give up owner's hold on the lock with the given name. returns False if
+        owner did not hold it.
+        """
+        
+        queryset = self.filter(name=name, owner=owner)
+        held = queryset.exists()
+        queryset.delete()
+        return held
+    
+    def held(self, name, now=None):
+        """
+        the current holder of the lock with the given name, if any
+        """
+        
+        if now is None:
+            now = database_now(self.db)
+        try:
+            return self.get(name=name, expires__gte=now)
+        except self.model.DoesNotExist:
+            return None
+
+
+class Lock(models.Model):
+    """
+    A lock shared by every host using the database (see mailer.dblock).
+    """
+    
+    name = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=128)
+    expires = models.DateTimeField()
+    
+    objects = LockManager()
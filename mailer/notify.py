@@ -0,0 +1,229 @@
+"""
+Wakes mailer.engine.send_loop() up as soon as mail is queued, rather than
+leaving it to find the mail the next time it polls the queue.
+
+On PostgreSQL this uses LISTEN/NOTIFY, so it works across hosts and a
+notification is only delivered once the mail it announces is committed.
+Elsewhere a datagram is sent to the Unix socket of every listening process,
+which only reaches loops running on the same host.
+
+Messages saved inside a transaction are announced once, after it ends: at
+the end of the request, or when flush() is called.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+
+# how to notify: "postgresql", "socket", "auto" (the former on PostgreSQL and
+# the latter elsewhere) or None to rely on polling alone.
+NOTIFY = getattr(settings, "MAILER_NOTIFY", "auto")
+
+# the directory holding the socket of each listening process. by default one
+# in the temporary directory named after the database, so that projects
+# sharing a host do not wake each other up.
+NOTIFY_SOCKET_DIR = getattr(settings, "MAILER_NOTIFY_SOCKET_DIR", None)
+
+CHANNEL = "mailer_message"
+
+# the databases with messages saved in a transaction that has not been
+# announced yet, per thread
+_pending = threading.local()
+
+
+def get_method(using=DEFAULT_DB_ALIAS):
+    if NOTIFY != "auto":
+        return NOTIFY
+    if getattr(connections[using], "vendor", None) == "postgresql":
+        return "postgresql"
+    if hasattr(socket, "AF_UNIX"):
+        return "socket"
+    return None
+
+
+def get_socket_dir(using=DEFAULT_DB_ALIAS):
+    if NOTIFY_SOCKET_DIR:
+        return NOTIFY_SOCKET_DIR
+    name = hashlib.md5(repr(settings.DATABASES[using]["NAME"])).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), "django-mailer-%s" % name)
+
+
+def notify(using=DEFAULT_DB_ALIAS):
+    """
+    Tell a waiting send_loop() that mail has been queued in the database
+    using. Does nothing if no loop is listening.
+    """
+
+    method = get_method(using)
+    if method == "postgresql":
+        cursor = connections[using].cursor()
+        cursor.execute("NOTIFY %s" % CHANNEL)
+        transaction.commit_unless_managed(using=using)
+    elif method == "socket":
+        directory = get_socket_dir(using)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            # nobody has listened yet
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        try:
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    sock.sendto("1", path)
+                except socket.error, err:
+                    if err.args[0] == errno.ECONNREFUSED:
+                        # left behind by a process that died
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                    # otherwise a wake-up is already pending
+        finally:
+            sock.close()
+
+
+def notify_on_commit(using=DEFAULT_DB_ALIAS):
+    """
+    notify() once the current transaction on using ends, or now if there
+    is none. Within a transaction, however many messages are saved, only one
+    notification is sent, by flush().
+    """
+
+    if transaction.is_managed(using=using):
+        if not hasattr(_pending, "databases"):
+            _pending.databases = set()
+        _pending.databases.add(using)
+    else:
+        notify(using)
+
+
+def flush(using=None, **kwargs):
+    """
+    Send the notifications held back by notify_on_commit(), for the database
+    using or all of them. This is done at the end of every request; code
+    queuing mail in transactions of its own outside a request should call it
+    once they are committed, or the mail waits for the loop's next check of
+    the queue.
+    """
+
+    databases = getattr(_pending, "databases", None) or set()
+    if using is None:
+        _pending.databases = set()
+    elif using in databases:
+        databases.discard(using)
+        databases = [using]
+    else:
+        return
+    for alias in databases:
+        notify(alias)
+
+request_finished.connect(flush)
+
+
+class Listener(object):
+    """
+    The receiving end of notify() for the database using. If it cannot be set
+    up, wait() simply sleeps, so the loop falls back to polling.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.pg_connection = None
+        self.sock = None
+        self.path = None
+        method = get_method(using)
+        try:
+            if method == "postgresql":
+                self.listen_postgresql()
+            elif method == "socket":
+                self.listen_socket()
+        except Exception, err:
+            logging.warning("could not listen for queued mail, polling instead: %s" % err)
+            self.close()
+
+    def listen_postgresql(self):
+        import psycopg2
+
+        db = settings.DATABASES[self.using]
+        params = {"database": db["NAME"]}
+        for key, name in (("USER", "user"), ("PASSWORD", "password"), ("HOST", "host"), ("PORT", "port")):
+            if db.get(key):
+                params[name] = db[key]
+        self.pg_connection = psycopg2.connect(**params)
+        self.pg_connection.set_isolation_level(0) # autocommit
+        self.pg_connection.cursor().execute("LISTEN %s" % CHANNEL)
+
+    def listen_socket(self):
+        directory = get_socket_dir(self.using)
+        try:
+            os.mkdir(directory, 0700)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        path = os.path.join(directory, "%s.sock" % os.getpid())
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            # left behind by an earlier process with the same id
+            os.unlink(path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+        sock.bind(path)
+        sock.setblocking(0)
+        self.sock = sock
+        self.path = path
+
+    def wait(self, timeout):
+        """
+        Block until mail is queued or timeout seconds have passed.
+        """
+
+        if self.pg_connection is not None:
+            if self.select(self.pg_connection, timeout):
+                self.pg_connection.poll()
+                del self.pg_connection.notifies[:]
+        elif self.sock is not None:
+            if self.select(self.sock, timeout):
+                # several messages may have been queued; one pass sends them all
+                try:
+                    while self.sock.recv(64):
+                        pass
+                except socket.error:
+                    pass
+        else:
+            time.sleep(timeout)
+    
+    def select(self, fileobj, timeout):
+        try:
+            return select.select([fileobj], [], [], timeout)[0]
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            # interrupted by a signal, let the caller see what it was for
+            return []
+
+    def close(self):
+        if self.pg_connection is not None:
+            self.pg_connection.close()
+            self.pg_connection = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,203 @@
+"""
+Runs the engine in several forked worker processes rather than threads, for
+deliveries that spend their time building and encoding messages rather than
+waiting on the network.
+
+Each worker has its own database connection and connection pool. Workers
+share the queue by leasing (see Message.objects.claim), so none of them takes
+the send lock; for a single pass, the supervising parent process holds it
+instead. The parent replaces workers that crash and adds up the sent and
+deferred counts they report.
+"""
+
+import os
+import sys
+import time
+import errno
+import random
+import select
+import signal
+import logging
+
+from django.db import close_connection
+
+from mailer import engine
+from mailer.models import Message
+
+
+class Supervisor(object):
+    """
+    Forks processes workers, each calling target(report), where report is a
+    function to call with a (sent, deferred) tuple after each pass.
+    
+    Unless keep_running is set, a worker that crashes is only replaced while
+    mail is still available, and at most processes times per run; a worker
+    that finishes is not replaced. With keep_running, workers are replaced
+    whenever they exit, at most once a second each, until stop() is called.
+    
+    If lock is given, the workers are stopped as soon as it is lost (see
+    mailer.dblock).
+    """
+    
+    def __init__(self, processes, target, keep_running=False, lock=None):
+        self.processes = processes
+        self.target = target
+        self.keep_running = keep_running
+        self.lock = lock
+        self.children = set()
+        self.stopping = False
+        self.restarts = 0
+        self.sent = 0
+        self.deferred = 0
+        self.pending = ""
+    
+    def stop(self):
+        """
+        Ask every worker to stop once it is done with the message it is
+        sending. Safe to call from a signal handler.
+        """
+        
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    
+    def spawn(self):
+        # don't share the parent's database connection with the child
+        close_connection()
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        
+        status = 0
+        try:
+            try:
+                os.close(self.read_fd)
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+                # so workers don't all draw the same retry jitter
+                random.seed()
+                self.target(self.report)
+            except:
+                logging.exception("worker %s crashed" % os.getpid())
+                status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+    
+    def report(self, counts):
+        # lines this short are written to a pipe in one piece
+        os.write(self.write_fd, "%s %s\n" % counts)
+    
+    def read_reports(self, timeout):
+        try:
+            ready = select.select([self.read_fd], [], [], timeout)[0]
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return
+        if not ready:
+            return
+        data = os.read(self.read_fd, 4096)
+        lines = (self.pending + data).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            sent, deferred = line.split()
+            self.sent += int(sent)
+            self.deferred += int(deferred)
+    
+    def reap(self):
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            self.children.discard(pid)
+            crashed = not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0
+            if crashed:
+                logging.warning("worker %s exited with status %s" % (pid, status))
+            if self.should_replace(crashed):
+                if self.keep_running:
+                    time.sleep(1)
+                self.spawn()
+    
+    def should_replace(self, crashed):
+        if self.stopping:
+            return False
+        if self.keep_running:
+            return True
+        if not crashed or self.restarts >= self.processes:
+            return False
+        self.restarts += 1
+        return Message.objects.available().exists()
+    
+    def run(self):
+        """
+        Run the workers until they have all finished. Returns the sum of the
+        (sent, deferred) counts they reported.
+        """
+        
+        self.read_fd, self.write_fd = os.pipe()
+        try:
+            for i in range(self.processes):
+                self.spawn()
+            while self.children:
+                self.read_reports(0.5)
+                self.reap()
+                if not self.stopping and engine.lock_lost(self.lock):
+                    self.stop()
+            self.read_reports(0)
+        finally:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+        return self.sent, self.deferred
+
+
+def send_all(processes, concurrency=None, use_lock=None):
+    """
+    Make one pass through the queue with processes worker processes, each
+    sending with concurrency threads (see mailer.engine.send_all). Returns a
+    (sent, deferred) tuple, or None if the send lock could not be taken.
+    
+    use_lock defaults to USE_FILE_LOCK, as in mailer.engine.drain_queue.
+    """
+    
+    def target(report):
+        report(engine.send_all(concurrency, use_lock=False) or (0, 0))
+    
+    if use_lock is None:
+        use_lock = engine.USE_FILE_LOCK
+    
+    lock = None
+    if use_lock:
+        lock = engine.take_lock(engine.make_lease_owner())
+        if lock is None:
+            return None
+    
+    start_time = time.time()
+    try:
+        sent, deferred = Supervisor(processes, target, lock=lock).run()
+    finally:
+        if use_lock:
+            engine.release_lock(lock)
+    logging.info("")
+    logging.info("all workers: %s sent; %s deferred;" % (sent, deferred))
+    logging.info("done in %.2f seconds" % (time.time() - start_time))
+    return sent, deferred
+
+
+def daemon_worker(report):
+    """
+    The target of a Supervisor running mailer.engine.Daemon in each worker.
+    """
+    
+    daemon = engine.Daemon(use_lock=False, report=report)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: daemon.stop())
+        signal.siginterrupt(signum, False)
+    # the supervisor decides what a SIGHUP means
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    daemon.run()
@@ -0,0 +1,90 @@
+"""
+Messages rendered to their final form when they are queued (see
+MAILER_PRERENDER), so sending them takes no more than writing out bytes.
+"""
+
+from email import message_from_string
+
+from django.core.mail import EmailMessage
+
+
+class RenderedMessage(object):
+    """
+    Stands in for the email.message.Message that EmailMessage.message()
+    returns. as_string() gives back the rendered text as it is; anything else
+    is looked up on the parsed text.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_string(self, unixfrom=False):
+        return self.data
+
+    def parsed(self):
+        parsed = self.__dict__.get("_parsed")
+        if parsed is None:
+            parsed = self._parsed = message_from_string(self.data)
+        return parsed
+
+    def __getattr__(self, name):
+        return getattr(self.parsed(), name)
+
+    def __getitem__(self, name):
+        return self.parsed()[name]
+
+
+class PrerenderedEmail(EmailMessage):
+    """
+    An EmailMessage reduced to its envelope (from_email and the to, cc and
+    bcc recipients) and its rendered text, which message() hands back without
+    building the MIME tree again. The subject is kept for display, and the
+    body and alternatives are read back from the text when asked for.
+    """
+
+    def __init__(self, email):
+        # EmailMessage.__init__ is not called; there is nothing to build
+        self.subject = email.subject
+        self.from_email = email.from_email
+        self.to = list(email.to)
+        self.cc = list(getattr(email, "cc", []))
+        self.bcc = list(email.bcc)
+        self.encoding = email.encoding
+        self.extra_headers = {}
+        self.connection = None
+        data = email.message().as_string()
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.data = data
+
+    def message(self):
+        return RenderedMessage(self.data)
+
+    def _texts(self, subtype):
+        for part in self.message().parsed().walk():
+            if (part.get_content_maintype() == "text" and part.get_content_subtype() == subtype
+                    and not part.get("Content-Disposition", "").startswith("attachment")):
+                payload = part.get_payload(decode=True) or ""
+                yield payload.decode(part.get_content_charset() or "utf-8", "replace")
+
+    @property
+    def body(self):
+        for text in self._texts("plain"):
+            return text
+        return u""
+
+    @property
+    def alternatives(self):
+        return [(text, "text/html") for text in self._texts("html")]
+
+    # the attachments are part of the rendered text, which cannot be changed;
+    # build a new EmailMessage instead of reusing this one
+
+    @property
+    def attachments(self):
+        raise AttributeError("the attachments of a pre-rendered message are part of its text")
+
+    def attach(self, *args, **kwargs):
+        raise TypeError("a pre-rendered message cannot be changed")
+
+    attach_file = attach
@@ -0,0 +1,111 @@
+"""
+Spreads mail across several relays and fails over between them.
+
+MAILER_RELAYS lists the relays, each as a dict of connection arguments for
+the backend (host, port, username, password, use_tls) plus, optionally, a
+"weight" (default 1) and a "backend" to use instead of MAILER_EMAIL_BACKEND:
+
+    MAILER_RELAYS = [
+        {"host": "smtp1.example.com", "weight": 3},
+        {"host": "smtp2.example.com", "port": 587, "use_tls": True},
+    ]
+
+Messages queued with connection arguments of their own are still sent with
+those. Every other message goes to the relay picked by
+MAILER_RELAY_STRATEGY. A relay whose circuit breaker is open (see
+mailer.breaker) is passed over, and a message that cannot be handed to one
+relay is tried on the next.
+"""
+
+import threading
+
+from django.conf import settings
+
+
+RELAYS = getattr(settings, "MAILER_RELAYS", [])
+
+# how to pick a relay: "round_robin" sends to each in proportion to its
+# weight; "least_outstanding" picks the one with the fewest messages in
+# flight for its weight.
+STRATEGY = getattr(settings, "MAILER_RELAY_STRATEGY", "round_robin")
+
+
+class Relay(object):
+
+    def __init__(self, index, options):
+        options = dict(options)
+        self.weight = options.pop("weight", 1)
+        self.backend = options.pop("backend", None)
+        self.connection_kwargs = options
+        self.key = ("relay", index)
+        self.name = "%s:%s" % (options.get("host", getattr(settings, "EMAIL_HOST", "")),
+                               options.get("port", getattr(settings, "EMAIL_PORT", "")))
+        self.outstanding = 0
+        self.current_weight = 0
+
+
+class Relays(object):
+    """
+    The relays of one process, shared by its threads.
+    """
+
+    def __init__(self, relays=None, strategy=None):
+        if relays is None:
+            relays = RELAYS
+        if strategy is None:
+            strategy = STRATEGY
+        if strategy not in ("round_robin", "least_outstanding"):
+            raise ValueError("unknown MAILER_RELAY_STRATEGY %r" % strategy)
+        self.relays = [Relay(i, options) for i, options in enumerate(relays or [])]
+        self.strategy = strategy
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.relays)
+
+    def order(self):
+        """
+        The relays, best first.
+        """
+
+        self.lock.acquire()
+        try:
+            if self.strategy == "least_outstanding":
+                return sorted(self.relays, key=lambda r: (float(r.outstanding) / r.weight, -r.weight))
+            # smooth weighted round robin: each relay gains its weight every
+            # time and the one with the most gives up the total when picked,
+            # so picks are spread out rather than bunched by relay.
+            total = 0
+            for relay in self.relays:
+                relay.current_weight += relay.weight
+                total += relay.weight
+            best = max(self.relays, key=lambda r: r.current_weight)
+            best.current_weight -= total
+            return [best] + sorted([r for r in self.relays if r is not best], key=lambda r: -r.weight)
+        finally:
+            self.lock.release()
+
+    def choose(self, breakers):
+        """
+        Yield (relay, breaker) for each relay worth trying, best first,
+        checking each breaker only when the previous relay has failed.
+        """
+
+        for relay in self.order():
+            breaker = breakers.get_for(relay.key, relay.name)
+            if breaker is None or breaker.allow():
+                yield relay, breaker
+
+    def started(self, relay):
+        self.lock.acquire()
+        try:
+            relay.outstanding += 1
+        finally:
+            self.lock.release()
+
+    def finished(self, relay):
+        self.lock.acquire()
+        try:
+            relay.outstanding -= 1
+        finally:
+            self.lock.release()
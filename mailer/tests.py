@@ -0,0 +1,787 @@
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+from socket import error as socket_error
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from mailer import async_engine, engine, files, models, notify, prefork, send_html_mail
+from mailer.breaker import Breakers, CircuitBreaker
+from mailer.dblock import DatabaseLock
+from mailer.models import Message, MessageLog, Attachment, ConnectionProfile, DontSendEntry, Lock, MissingAttachment, make_message
+from mailer.prerender import PrerenderedEmail
+from mailer.relays import Relays
+from mailer.throttle import Throttle
+
+
+LOCMEM_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+
+
+def make_email(subject, content, to="to@example.com"):
+    email = EmailMessage(subject, "body", "from@example.com", [to])
+    email.attach("report.pdf", content, "application/pdf")
+    return email
+
+
+class AttachmentStoreTest(TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(1024)
+        self.old_settings = engine.EMAIL_BACKEND, models.ATTACHMENT_STORE_THRESHOLD
+        engine.EMAIL_BACKEND = LOCMEM_BACKEND
+        models.ATTACHMENT_STORE_THRESHOLD = 1024
+
+    def tearDown(self):
+        engine.EMAIL_BACKEND, models.ATTACHMENT_STORE_THRESHOLD = self.old_settings
+
+    def refcounts(self):
+        return list(Attachment.objects.values_list("refcount", flat=True))
+
+    def test_enqueue_many_stores_once(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, self.content) for i in range(3)])
+        self.assertEqual(self.refcounts(), [3])
+        for message in Message.objects.all():
+            self.assertEqual(message.email.attachments[0][1], self.content)
+
+    def test_small_attachments_stay_inline(self):
+        Message.objects.enqueue_many([make_email("s", "small")])
+        self.assertEqual(self.refcounts(), [])
+        self.assertEqual(Message.objects.get().email.attachments[0][1], "small")
+
+    def test_save(self):
+        message = make_message("s", "b", "from@example.com", ["to@example.com"], priority="2",
+                               attachments=[("a.pdf", self.content, "application/pdf")])
+        # readable before it is saved
+        self.assertEqual(message.email.attachments[0][1], self.content)
+        message.save()
+        self.assertEqual(self.refcounts(), [1])
+        message.save()
+        self.assertEqual(self.refcounts(), [1])
+
+    def test_save_replacing_email(self):
+        Message.objects.enqueue_many([make_email("s", self.content)])
+        message = Message.objects.get()
+        message.email = make_email("s", "small")
+        message.email = make_email("s", "small")
+        self.assertEqual(self.refcounts(), [1])
+        message.save()
+        self.assertEqual(self.refcounts(), [])
+
+    def test_failed_save(self):
+        message = make_message("s", "b", "from@example.com", ["to@example.com"], priority=None,
+                               attachments=[("a.pdf", self.content, "application/pdf")])
+        self.assertRaises(Exception, message.save)
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(self.refcounts(), [])
+
+    def test_flush_sent(self):
+        Message.objects.enqueue_many([make_email("s", self.content)])
+        buffer = engine.ResultBuffer()
+        buffer.sent(Message.objects.get())
+        buffer.flush()
+        # the log entry took over the message's reference
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(self.refcounts(), [1])
+        self.assertEqual(MessageLog.objects.get().email.attachments[0][1], self.content)
+
+    def test_flush_deferred(self):
+        Message.objects.enqueue_many([make_email("s", self.content)])
+        buffer = engine.ResultBuffer()
+        buffer.deferred(Message.objects.get(), "failed")
+        buffer.flush()
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(self.refcounts(), [2])
+
+    def test_delete(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, self.content) for i in range(2)])
+        MessageLog.objects.log(Message.objects.all()[0], 3, "failed")
+        self.assertEqual(self.refcounts(), [3])
+        Message.objects.all()[0].delete()
+        self.assertEqual(self.refcounts(), [2])
+        Message.objects.all().delete()
+        self.assertEqual(self.refcounts(), [1])
+        MessageLog.objects.all().delete()
+        self.assertEqual(self.refcounts(), [])
+
+    def test_delete_ids(self):
+        # the raw DELETE leaves the references to whoever deletes the messages
+        Message.objects.enqueue_many([make_email("s", self.content)])
+        Message.objects.delete_ids([Message.objects.get().pk])
+        self.assertEqual(self.refcounts(), [1])
+
+    def test_missing_attachment_is_deferred(self):
+        Message.objects.enqueue_many([make_email("s", self.content)])
+        Attachment.objects.all().delete()
+        self.assertRaises(MissingAttachment, lambda: Message.objects.get().email)
+        self.assertEqual(engine.send_all(), (0, 1))
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(MessageLog.objects.get().attachment_digests, "")
+
+
+class EnqueueTransactionTest(TransactionTestCase):
+
+    def test_rolled_back_with_the_caller(self):
+        @transaction.commit_on_success
+        def queue():
+            Message.objects.enqueue_many([make_email("s", "small")])
+            raise ValueError
+        self.assertRaises(ValueError, queue)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class LeaseTest(TestCase):
+
+    def setUp(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, "small") for i in range(6)])
+        # the atomic UPDATE, as on SQLite
+        self.old_skip_locked = models.SKIP_LOCKED
+        models.SKIP_LOCKED = False
+
+    def tearDown(self):
+        models.SKIP_LOCKED = self.old_skip_locked
+        Message.objects.__dict__.pop("available", None)
+
+    def test_owners_never_share_a_message(self):
+        first = Message.objects.claim("first", 4, 60)
+        second = Message.objects.claim("second", 4, 60)
+        self.assertEqual((len(first), len(second)), (4, 2))
+        self.assertEqual(set(m.pk for m in first) & set(m.pk for m in second), set())
+        self.assertEqual(Message.objects.claim("third", 4, 60), [])
+
+    def test_loser_of_a_race_claims_the_rest(self):
+        available = Message.objects.available
+        calls = []
+
+        def race(now=None):
+            calls.append(now)
+            if len(calls) == 2:
+                # another worker takes the candidates between the SELECT and
+                # the UPDATE
+                ids = list(available(now).order_by("priority", "when_added")
+                           .values_list("id", flat=True)[:3])
+                Message.objects.filter(id__in=ids).update(
+                    lease_owner="first", lease_expires=now + timedelta(seconds=60))
+            return available(now)
+        Message.objects.available = race
+        second = Message.objects.claim("second", 3, 60)
+        first = Message.objects.filter(lease_owner="first")
+        # the UPDATE took none, so the candidates were picked again
+        self.assertEqual(len(calls), 4)
+        self.assertEqual((len(second), first.count()), (3, 3))
+        self.assertEqual(set(m.pk for m in second) & set(m.pk for m in first), set())
+
+    def test_expired_lease_is_reclaimed(self):
+        claimed = Message.objects.claim("dead", 6, 60)
+        Message.objects.filter(pk=claimed[0].pk).update(
+            lease_expires=datetime.now() - timedelta(seconds=1))
+        self.assertEqual([m.pk for m in Message.objects.claim("alive", 6, 60)], [claimed[0].pk])
+
+    def test_release_frees_only_the_owners_messages(self):
+        Message.objects.claim("first", 2, 60)
+        Message.objects.claim("second", 2, 60)
+        self.assertEqual(Message.objects.release("first"), 2)
+        self.assertEqual(Message.objects.filter(lease_owner="second").count(), 2)
+        self.assertEqual(Message.objects.leased().count(), 2)
+        self.assertEqual(len(Message.objects.claim("third", 6, 60)), 4)
+
+
+class ConnectionProfileTest(TransactionTestCase):
+
+    def setUp(self):
+        ConnectionProfile.objects.invalidate_cache()
+
+    def test_saved_profile_is_reloaded(self):
+        profile = ConnectionProfile.objects.for_kwargs({"host": "a.example.com"})
+        self.assertEqual(ConnectionProfile.objects.get_cached(profile.pk).connection_kwargs,
+                         {"host": "a.example.com"})
+        profile = ConnectionProfile.objects.get(pk=profile.pk)
+        profile.connection_kwargs_data = models.object_to_db({"host": "b.example.com"})
+        profile.save()
+        self.assertEqual(ConnectionProfile.objects.get_cached(profile.pk).connection_kwargs,
+                         {"host": "b.example.com"})
+
+    def test_deleted_profile_is_forgotten(self):
+        profile = ConnectionProfile.objects.for_kwargs({"host": "a.example.com"})
+        profile.delete()
+        self.assertRaises(ConnectionProfile.DoesNotExist,
+                          ConnectionProfile.objects.get_cached, profile.pk)
+        ConnectionProfile.objects.for_kwargs({"host": "a.example.com"})
+        self.assertEqual(ConnectionProfile.objects.count(), 1)
+
+    def test_rolled_back_profile_is_not_cached(self):
+        @transaction.commit_on_success
+        def create():
+            ConnectionProfile.objects.for_kwargs({"host": "a.example.com"})
+            raise ValueError
+        self.assertRaises(ValueError, create)
+        ConnectionProfile.objects.for_kwargs({"host": "a.example.com"})
+        self.assertEqual(ConnectionProfile.objects.count(), 1)
+
+
+class DeferTest(TestCase):
+
+    def test_defer_many_spreads_retries(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, "small") for i in range(50)])
+        Message.objects.defer_many(Message.objects.all())
+        self.assertEqual(set(Message.objects.values_list("attempts", flat=True)), set([1]))
+        # each message draws its own jitter
+        times = set(Message.objects.values_list("next_attempt_at", flat=True))
+        self.assertTrue(len(times) > 1)
+
+
+class RecipientTest(TestCase):
+
+    def setUp(self):
+        self.email = EmailMessage("s", "body", "from@example.com", ["To <To@Example.com>"],
+                                  cc=["cc@example.com"], bcc=["bcc@example.com"])
+
+    def test_found_by_any_recipient(self):
+        Message.objects.enqueue_many([self.email, make_email("other", "small")])
+        make_message("s2", "b", "from@example.com", ["cc@example.com"], priority="2").save()
+        for address in ["to@example.com", "CC@example.com", "bcc@example.com"]:
+            self.assertEqual(Message.objects.sent_to(address).filter(subject="s").count(), 1)
+        self.assertEqual(Message.objects.sent_to("cc@example.com").count(), 2)
+        self.assertEqual(Message.objects.sent_to("nobody@example.com").count(), 0)
+
+    def test_log_shares_the_rows(self):
+        Message.objects.enqueue_many([self.email])
+        old_backend = engine.EMAIL_BACKEND
+        engine.EMAIL_BACKEND = LOCMEM_BACKEND
+        try:
+            engine.send_all()
+        finally:
+            engine.EMAIL_BACKEND = old_backend
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(MessageLog.objects.sent_to("bcc@example.com").count(), 1)
+        MessageLog.objects.all().delete()
+        self.assertEqual(models.Recipient.objects.count(), 0)
+
+    def test_replaced_email(self):
+        message = make_message("s", "b", "from@example.com", ["old@example.com"], priority="2")
+        message.save()
+        message.email = self.email
+        message.save()
+        self.assertEqual(Message.objects.sent_to("old@example.com").count(), 0)
+        self.assertEqual(Message.objects.sent_to("to@example.com").count(), 1)
+        self.assertEqual(models.Recipient.objects.count(), 3)
+
+
+class ThrottleTest(TestCase):
+
+    def test_rate_limited_send_leaves_its_slot_free(self):
+        throttle = Throttle(concurrency=2, domain_rates={"slow.example.com": 1}, adaptive=True)
+        slow = make_message("s", "b", "from@example.com", ["to@slow.example.com"])
+        fast = make_message("s", "b", "from@example.com", ["to@example.com"])
+        throttle.finish(throttle.start(slow))
+        # one send at a time over the connection both go out on
+        throttle.get_limit(slow.connection_key).limit = 1.0
+        # the next one to slow.example.com waits a second for its token
+        waiting = threading.Thread(target=lambda: throttle.finish(throttle.start(slow)))
+        waiting.start()
+        time.sleep(0.1)
+        start_time = time.time()
+        throttle.finish(throttle.start(fast))
+        self.assertTrue(time.time() - start_time < 0.5)
+        waiting.join()
+
+
+class RelayThrottleTest(TestCase):
+
+    def test_relayed_sends_are_throttled_per_relay(self):
+        throttle = Throttle(concurrency=2, connection_rate=1000, adaptive=True)
+        relays = Relays([{"backend": LOCMEM_BACKEND}, {"backend": LOCMEM_BACKEND}])
+        sender = engine.MessageSender(throttle=throttle, relays=relays)
+        Message.objects.enqueue_many([make_email("s%d" % i, "small") for i in range(2)])
+        for message in Message.objects.all():
+            self.assertTrue(sender.send(message))
+        sender.close()
+        keys = set(relay.key for relay in relays.relays)
+        self.assertEqual(set(throttle.limits), keys)
+        self.assertEqual(set(throttle.buckets), set(("connection", key) for key in keys))
+
+
+class DatabaseLockTest(TestCase):
+
+    def setUp(self):
+        self.old_renew = Lock.objects.renew
+        self.calls = []
+
+    def tearDown(self):
+        Lock.objects.renew = self.old_renew
+
+    def hold(self, ttl, *results):
+        # renew() answers with results in turn, raising those that are errors
+        def renew(name, owner, ttl):
+            result = results[min(len(self.calls), len(results) - 1)]
+            self.calls.append(result)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        Lock.objects.renew = renew
+        lock = DatabaseLock("send", "owner", ttl=ttl, heartbeat=0.01)
+        lock.acquire(0)
+        deadline = time.time() + 0.2
+        while time.time() < deadline and not lock.lost:
+            time.sleep(0.01)
+        lock.stopped.set()
+        lock.thread.join()
+        return lock
+
+    def test_renewal_survives_errors(self):
+        lock = self.hold(10, Exception("gone away"), True)
+        self.assertFalse(lock.lost)
+
+    def test_lost_when_errors_outlast_the_hold(self):
+        lock = self.hold(0.05, Exception("gone away"))
+        self.assertTrue(lock.lost)
+
+    def test_send_stops_when_lock_lost(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, "small") for i in range(3)])
+        lock = DatabaseLock("send", "owner")
+        messages = engine.prioritize("owner", lock)
+        messages.next()
+        lock.lost = True
+        self.assertEqual(list(messages), [])
+
+    def test_expiry_by_the_database_clock(self):
+        # a database server whose clock is an hour behind this host's
+        models.DATABASE_NOW["sqlite"] = ("SELECT datetime('now', 'localtime', '-1 hour') "
+                                         "AS \"now [timestamp]\"")
+        try:
+            self.assertTrue(Lock.objects.acquire("send", "first", 10))
+            self.assertFalse(Lock.objects.acquire("send", "second", 10))
+            self.assertEqual(Lock.objects.held("send").owner, "first")
+        finally:
+            del models.DATABASE_NOW["sqlite"]
+
+
+class DontSendCacheTest(TestCase):
+
+    def setUp(self):
+        self.old_cache = models.DONT_SEND_CACHE
+        models.DONT_SEND_CACHE = True
+        DontSendEntry.objects.invalidate_cache()
+
+    def tearDown(self):
+        models.DONT_SEND_CACHE = self.old_cache
+        DontSendEntry.objects.invalidate_cache()
+
+    def test_edited_entry_is_reloaded(self):
+        DontSendEntry.objects.create(to_address="a@example.com")
+        self.assertTrue(DontSendEntry.objects.has_address("a@example.com"))
+        # as another process would, without this one hearing of it
+        DontSendEntry.objects.update(to_address="b@example.com", normalized_address="b@example.com")
+        self.assertTrue(DontSendEntry.objects.has_address("a@example.com"))
+        DontSendEntry.objects._cache["loaded"] -= models.DONT_SEND_CACHE_TTL + 1
+        self.assertFalse(DontSendEntry.objects.has_address("a@example.com"))
+        self.assertTrue(DontSendEntry.objects.has_address("b@example.com"))
+
+
+class PreforkTest(TestCase):
+
+    def test_send_all_needs_the_lock(self):
+        Message.objects.enqueue_many([make_email("s", "small")])
+        lock = engine.take_lock("someone else")
+        try:
+            self.assertEqual(prefork.send_all(2, use_lock=True), None)
+        finally:
+            engine.release_lock(lock)
+        self.assertEqual(Message.objects.count(), 1)
+
+
+class NotifyTest(TestCase):
+
+    def setUp(self):
+        self.old_notify = notify.notify
+        self.notified = []
+        # drop whatever earlier tests left pending
+        notify.notify = lambda using: None
+        notify.flush()
+        notify.notify = self.notified.append
+
+    def tearDown(self):
+        notify.notify = self.old_notify
+
+    def test_once_per_transaction(self):
+        # TestCase runs each test in a transaction
+        for i in range(3):
+            make_message("s%d" % i, "b", "from@example.com", ["to@example.com"], priority="2").save()
+        Message.objects.enqueue_many([make_email("s", "small")])
+        self.assertEqual(self.notified, [])
+        notify.flush()
+        self.assertEqual(self.notified, ["default"])
+        notify.flush()
+        self.assertEqual(self.notified, ["default"])
+
+
+class AsyncEngineTest(TestCase):
+
+    def setUp(self):
+        self.sink = async_engine.SMTPSink()
+        self.old_settings = settings.EMAIL_HOST, settings.EMAIL_PORT, settings.EMAIL_USE_TLS
+        settings.EMAIL_HOST, settings.EMAIL_PORT = self.sink.address
+        settings.EMAIL_USE_TLS = False
+
+    def tearDown(self):
+        settings.EMAIL_HOST, settings.EMAIL_PORT, settings.EMAIL_USE_TLS = self.old_settings
+        self.sink.close()
+
+    def test_send_all(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, "small", "to%d@example.com" % i)
+                                      for i in range(5)])
+        self.assertEqual(async_engine.send_all(sessions=2), (5, 0))
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(sorted(r[1] for r in self.sink.received),
+                         [["to%d@example.com" % i] for i in range(5)])
+
+
+    def session(self, username):
+        class Session(async_engine.SMTPSession):
+            # the reply handlers alone, without a connection
+            def __init__(self):
+                self.params = ("mx.example.com", 25, username, "secret")
+                self.extensions = {}
+                self.commands = []
+                self.failures = []
+            def command(self, line, state):
+                self.commands.append(line)
+            def fail(self, err):
+                self.failures.append(err)
+            def next_message(self):
+                self.commands.append("MAIL")
+        return Session()
+
+    def test_auth_needs_the_extension(self):
+        session = self.session("user")
+        session.reply_ehlo(250, "mx.example.com\nPIPELINING\nSIZE 1000")
+        self.assertEqual(session.commands, [])
+        self.assertEqual(str(session.failures[0]), "server does not support AUTH")
+        session = self.session(None)
+        session.reply_ehlo(250, "mx.example.com\nPIPELINING")
+        self.assertEqual(session.commands, ["MAIL"])
+
+    def test_auth_plain(self):
+        session = self.session("user")
+        session.reply_ehlo(250, "mx.example.com\nAUTH=LOGIN PLAIN")
+        self.assertEqual(session.commands, ["AUTH PLAIN AHVzZXIAc2VjcmV0"])
+        session.reply_auth(235, "ok")
+        self.assertEqual(session.commands[-1], "MAIL")
+        self.assertEqual(session.failures, [])
+
+    def test_only_235_is_authenticated(self):
+        session = self.session("user")
+        session.reply_auth(503, "already authenticated")
+        self.assertEqual(session.commands, [])
+        self.assertTrue(isinstance(session.failures[0], smtplib.SMTPAuthenticationError))
+
+
+class BreakerTest(TestCase):
+
+    def test_open_probe_close(self):
+        breaker = CircuitBreaker("relay", 2, 0.05)
+        breaker.record(socket_error("refused"))
+        self.assertTrue(breaker.allow())
+        breaker.record(socket_error("refused"))
+        # open
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        # half open: one probe at a time
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(None)
+        # closed
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker("relay", 1, 0.05)
+        breaker.record(socket_error("refused"))
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record(socket_error("refused"))
+        self.assertFalse(breaker.allow())
+
+    def test_state_kept_across_passes(self):
+        unreachable = {"host": "127.0.0.1", "port": 1}
+        Message.objects.enqueue_many([make_email("s%d" % i, "small") for i in range(2)],
+                                     connection_kwargs=unreachable)
+        old_backend = engine.EMAIL_BACKEND
+        engine.EMAIL_BACKEND = "mailer.backend.SMTPBackend"
+        breakers = Breakers(threshold=1, cooldown=60)
+        try:
+            # the first message opens the breaker and the second is skipped
+            self.assertEqual(engine.send_all(1, breakers=breakers), (0, 1))
+            # and stays skipped, without another connection attempt
+            self.assertEqual(engine.send_all(1, breakers=breakers), (0, 0))
+        finally:
+            engine.EMAIL_BACKEND = old_backend
+        self.assertEqual(Message.objects.deferred().count(), 1)
+
+    def test_send_loop_waits_when_all_skipped(self):
+        Message.objects.enqueue_many([make_email("s", "small")])
+        passes = []
+
+        class Stop(Exception):
+            pass
+
+        class Listener(object):
+            def __init__(self, using):
+                pass
+            def wait(self, timeout):
+                raise Stop
+            def close(self):
+                pass
+
+        def send_all(breakers=None):
+            passes.append(breakers)
+            return (0, 0)
+
+        old = engine.Listener, engine.send_all
+        engine.Listener, engine.send_all = Listener, send_all
+        try:
+            self.assertRaises(Stop, engine.send_loop)
+        finally:
+            engine.Listener, engine.send_all = old
+        self.assertEqual(len(passes), 1)
+        self.assertTrue(isinstance(passes[0], Breakers))
+
+
+class DaemonTest(TestCase):
+
+    def test_outcomes_written_before_crashing(self):
+        Message.objects.enqueue_many([make_email("s%d" % i, "small") for i in range(2)])
+        old_backend = engine.EMAIL_BACKEND
+        engine.EMAIL_BACKEND = LOCMEM_BACKEND
+        daemon = engine.Daemon()
+        daemon.sender = engine.MessageSender()
+        send = daemon.sender.send
+        sent = []
+
+        def send_once(message):
+            if sent:
+                raise RuntimeError("crashed")
+            sent.append(message)
+            return send(message)
+
+        daemon.sender.send = send_once
+        try:
+            self.assertRaises(RuntimeError, daemon.deliver, Message.objects.order_by("pk"))
+        finally:
+            engine.EMAIL_BACKEND = old_backend
+        # nothing left for another worker to send again
+        self.assertEqual(daemon.sender.results.log_entries, [])
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertEqual(sorted(MessageLog.objects.values_list("result", flat=True)), ["1", "3"])
+
+
+class PrerenderTest(TestCase):
+
+    def setUp(self):
+        self.old_prerender = models.PRERENDER
+        models.PRERENDER = True
+
+    def tearDown(self):
+        models.PRERENDER = self.old_prerender
+
+    def test_send_html_mail_keeps_attachments(self):
+        send_html_mail("s", "plain", "<b>html</b>", "from@example.com", ["to@example.com"],
+                       attachments=[("x.txt", "attached", "text/plain")])
+        message = Message.objects.get()
+        self.assertTrue(isinstance(message.email, PrerenderedEmail))
+        self.assertTrue('filename="x.txt"' in message.email.data)
+        self.assertEqual(message.body, "plain")
+        self.assertEqual(message.body_html, "<b>html</b>")
+
+    def test_prerendered_email_cannot_be_changed(self):
+        send_html_mail("s", "plain", "<b>html</b>", "from@example.com", ["to@example.com"])
+        email = Message.objects.get().email
+        self.assertRaises(AttributeError, lambda: email.attachments)
+        self.assertRaises(TypeError, email.attach, "y.txt", "more", "text/plain")
+
+
+class FileAttachmentTest(TransactionTestCase):
+
+    def setUp(self):
+        self.storage = FileSystemStorage(location=tempfile.mkdtemp())
+        self.old_storage = files.get_storage
+        files.get_storage = models.get_storage = lambda: self.storage
+
+    def tearDown(self):
+        files.get_storage = models.get_storage = self.old_storage
+        shutil.rmtree(self.storage.location)
+
+    def stored(self):
+        return self.storage.listdir(files.ATTACHMENT_UPLOAD_TO)[1]
+
+    def test_file_handle_without_name(self):
+        attachment = files.attach_file(StringIO("content"), "a.txt")
+        self.assertEqual(attachment.size, 7)
+        self.assertEqual(attachment.get_payload(decode=True), "content")
+
+    def test_copied_when_saved(self):
+        attachment = files.attach_file(StringIO("content"), "a.txt")
+        email = EmailMessage("s", "b", "from@example.com", ["to@example.com"])
+        email.attach(attachment)
+        message = Message(priority="2")
+        message.email = email
+        self.assertFalse(self.storage.exists(files.ATTACHMENT_UPLOAD_TO))
+        message.save()
+        self.assertEqual(len(self.stored()), 1)
+        self.assertEqual(Message.objects.get().email.attachments[0].get_payload(decode=True), "content")
+        Message.objects.all().delete()
+        self.assertEqual(self.stored(), [])
+
+    def test_stored_file_removed_on_rollback(self):
+        email = EmailMessage("s", "b", "from@example.com", ["to@example.com"])
+        email.attach(files.attach_file(StringIO("content"), "a.txt"))
+
+        @transaction.commit_on_success
+        def queue():
+            Message.objects.enqueue_many([email])
+            self.assertEqual(len(self.stored()), 1)
+            raise ValueError
+        self.assertRaises(ValueError, queue)
+        models.settle_files()
+        self.assertEqual(self.stored(), [])
+        # stored again from the file handle
+        Message.objects.enqueue_many([email])
+        self.assertEqual(Message.objects.get().email.attachments[0].get_payload(decode=True), "content")
+
+    def test_released_file_deleted_after_commit(self):
+        email = EmailMessage("s", "b", "from@example.com", ["to@example.com"])
+        email.attach(files.attach_file(StringIO("content"), "a.txt"))
+        Message.objects.enqueue_many([email])
+
+        @transaction.commit_on_success
+        def delete(fail):
+            Message.objects.all().delete()
+            self.assertEqual(len(self.stored()), 1)
+            if fail:
+                raise ValueError
+        self.assertRaises(ValueError, delete, True)
+        models.settle_files()
+        self.assertEqual(Message.objects.get().email.attachments[0].get_payload(decode=True), "content")
+        delete(False)
+        self.assertEqual(len(self.stored()), 1)
+        models.settle_files()
+        self.assertEqual(self.stored(), [])
+
+    def test_missing_file_is_deferred(self):
+        self.storage.save("shared/a.txt", ContentFile("content"))
+        email = EmailMessage("s", "b", "from@example.com", ["to@example.com"])
+        email.attach(files.attach_file("shared/a.txt"))
+        Message.objects.enqueue_many([email])
+        self.storage.delete("shared/a.txt")
+        old_backend = engine.EMAIL_BACKEND
+        engine.EMAIL_BACKEND = LOCMEM_BACKEND
+        try:
+            self.assertEqual(engine.send_all(), (0, 1))
+        finally:
+            engine.EMAIL_BACKEND = old_backend
+        self.assertEqual(Message.objects.deferred().count(), 1)
+        self.assertTrue("shared/a.txt" in MessageLog.objects.get().log_message)
+
+
+class ConnectionPoolTest(TestCase):
+
+    def test_discard_without_quit(self):
+        class SMTP(object):
+            closed = said_quit = False
+            def close(self):
+                self.closed = True
+            def quit(self):
+                self.said_quit = True
+        pool = engine.ConnectionPool()
+        connection = pool.get("key", None, LOCMEM_BACKEND)
+        smtp = connection.connection = SMTP()
+        pool.discard("key", quit=False)
+        self.assertTrue(smtp.closed)
+        self.assertFalse(smtp.said_quit)
+        self.assertEqual(pool.entries, {})
+
+    def test_least_recently_used_is_closed(self):
+        pool = engine.ConnectionPool(max_size=2, idle_timeout=60)
+        first = pool.get("first", None, LOCMEM_BACKEND)
+        second = pool.get("second", None, LOCMEM_BACKEND)
+        pool.entries["second"][1] -= 10
+        pool.get("first", None, LOCMEM_BACKEND)
+        pool.get("third", None, LOCMEM_BACKEND)
+        self.assertEqual(sorted(pool.entries), ["first", "third"])
+        self.assertTrue(pool.get("first", None, LOCMEM_BACKEND) is first)
+        self.assertFalse(pool.get("second", None, LOCMEM_BACKEND) is second)
+
+    def test_idle_connection_is_closed(self):
+        pool = engine.ConnectionPool(idle_timeout=60)
+        connection = pool.get("key", None, LOCMEM_BACKEND)
+        pool.expire(time.time() + 30)
+        self.assertEqual(pool.entries.keys(), ["key"])
+        pool.expire(time.time() + 61)
+        self.assertEqual(pool.entries, {})
+        self.assertFalse(pool.get("key", None, LOCMEM_BACKEND) is connection)
+
+    def test_recycled_after_max_messages(self):
+        pool = engine.ConnectionPool(max_messages=2)
+        connection = pool.get("key", None, LOCMEM_BACKEND)
+        self.assertTrue(pool.get("key", None, LOCMEM_BACKEND) is connection)
+        self.assertFalse(pool.get("key", None, LOCMEM_BACKEND) is connection)
+
+    def reused_connection(self, sender, smtp):
+        class Backend(object):
+            def send_messages(self, messages):
+                for message in messages:
+                    self.connection.sendmail(message.from_email, message.recipients(), "data")
+            def close(self):
+                pass
+        backend = Backend()
+        backend.connection = smtp
+        sender.pool.entries["key"] = [backend, time.time(), 1]
+
+    def test_stale_connection_is_replaced(self):
+        class SMTP(object):
+            def mail(self, sender):
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            def sendmail(self, sender, recipients, data):
+                self.mail(sender)
+            def close(self):
+                pass
+        breakers = Breakers(threshold=1)
+        sender = engine.MessageSender(breakers=breakers)
+        self.reused_connection(sender, SMTP())
+        message = make_message("s", "b", "from@example.com", ["to@example.com"], priority="2")
+        mail.outbox = []
+        breaker = breakers.get(message)
+        self.assertEqual(sender.attempt(message, "key", None, breaker, LOCMEM_BACKEND), None)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(breaker.allow())
+
+    def test_dropped_after_mail_from_is_not_retried(self):
+        class SMTP(object):
+            def mail(self, sender):
+                return (250, "ok")
+            def sendmail(self, sender, recipients, data):
+                self.mail(sender)
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            def close(self):
+                pass
+        sender = engine.MessageSender()
+        smtp = SMTP()
+        self.reused_connection(sender, smtp)
+        message = make_message("s", "b", "from@example.com", ["to@example.com"], priority="2")
+        mail.outbox = []
+        error = sender.attempt(message, "key", None, None, LOCMEM_BACKEND)
+        self.assertTrue(isinstance(error, smtplib.SMTPServerDisconnected))
+        self.assertEqual(mail.outbox, [])
+        self.assertFalse("mail" in smtp.__dict__)
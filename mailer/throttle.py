@@ -0,0 +1,233 @@
+"""
+Keeps senders within the rate a mail server or recipient domain accepts.
+
+Token buckets cap the messages per second sent over each connection (each
+distinct set of connection arguments, see Message.connection_key, or each
+relay, see mailer.relays) and to each recipient domain. With MAILER_ADAPTIVE_CONCURRENCY, the number of messages in
+flight over each connection is also adjusted as it goes: raised by one after
+every window of sends that are fast and accepted, and halved when a send is
+slow or the server answers with a temporary (4xx) error, which is how relays
+usually signal throttling.
+
+A Throttle is shared by the threads of one process. Limits are not shared
+between processes or hosts, so divide them among the workers you run.
+"""
+
+import time
+import threading
+
+from email.utils import parseaddr
+
+from django.conf import settings
+
+
+# messages per second allowed over each connection, or None for no limit,
+# and how many may be sent at once after a quiet spell (default: one
+# second's worth).
+CONNECTION_RATE = getattr(settings, "MAILER_CONNECTION_RATE", None)
+CONNECTION_BURST = getattr(settings, "MAILER_CONNECTION_BURST", None)
+
+# messages per second allowed to each recipient domain, e.g.
+# {"example.com": 5, "*": 20}. "*" applies to each domain not listed. a
+# message to several domains waits for all of them.
+DOMAIN_RATES = getattr(settings, "MAILER_DOMAIN_RATES", {})
+
+# whether to adjust how many messages are in flight over each connection by
+# additive increase/multiplicative decrease. it never goes above the number
+# of sending threads.
+ADAPTIVE_CONCURRENCY = getattr(settings, "MAILER_ADAPTIVE_CONCURRENCY", False)
+
+# with adaptive concurrency, a send taking longer than this many seconds
+# counts as a sign of overload, like a 4xx reply.
+TARGET_LATENCY = getattr(settings, "MAILER_TARGET_LATENCY", 2.0)
+
+
+class TokenBucket(object):
+    """
+    Allows rate events per second on average and up to burst at once.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, now=None):
+        """
+        Take a token and return how many seconds to wait before using it.
+        The bucket goes into debt rather than refusing, so several buckets
+        can be reserved at once and waited for together.
+        """
+
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+        finally:
+            self.lock.release()
+
+
+class ConcurrencyLimit(object):
+    """
+    A semaphore whose size is adjusted by additive increase/multiplicative
+    decrease, between 1 and maximum.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = 1.0
+        self.in_flight = 0
+        self.since_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        self.condition.acquire()
+        try:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        finally:
+            self.condition.release()
+
+    def release(self, overloaded):
+        self.condition.acquire()
+        try:
+            self.in_flight -= 1
+            self.since_decrease += 1
+            if overloaded:
+                # only once per window, so a burst of failures from sends
+                # that were all in flight together counts as one
+                if self.since_decrease >= self.limit:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.since_decrease = 0
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+
+def recipient_domains(email):
+    domains = set()
+    for address in email.recipients():
+        address = parseaddr(address)[1]
+        if "@" in address:
+            domains.add(address.rsplit("@", 1)[1].lower())
+    return domains
+
+
+def is_overload(err):
+    """
+    Whether err, raised while sending, is a temporary (4xx) SMTP reply.
+    """
+
+    code = getattr(err, "smtp_code", None)
+    if code is None:
+        # SMTPRecipientsRefused carries a reply per recipient
+        recipients = getattr(err, "recipients", None) or {}
+        codes = [reply[0] for reply in recipients.values()]
+        return bool(codes) and all(400 <= c < 500 for c in codes)
+    return 400 <= code < 500
+
+
+class Throttle(object):
+    """
+    The rate limits and concurrency limits for the senders of one process.
+    concurrency is the number of threads sending, which the adaptive limit
+    never exceeds.
+    """
+
+    def __init__(self, concurrency=1, connection_rate=None, connection_burst=None,
+                 domain_rates=None, adaptive=None):
+        if connection_rate is None:
+            connection_rate = CONNECTION_RATE
+        if connection_burst is None:
+            connection_burst = CONNECTION_BURST
+        if domain_rates is None:
+            domain_rates = DOMAIN_RATES
+        if adaptive is None:
+            adaptive = ADAPTIVE_CONCURRENCY
+        self.concurrency = concurrency
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.domain_rates = domain_rates
+        self.adaptive = adaptive and concurrency > 1
+        self.buckets = {}
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key, rate, burst=None):
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+            return bucket
+        finally:
+            self.lock.release()
+
+    def get_limit(self, key):
+        self.lock.acquire()
+        try:
+            limit = self.limits.get(key)
+            if limit is None:
+                limit = self.limits[key] = ConcurrencyLimit(self.concurrency)
+            return limit
+        finally:
+            self.lock.release()
+
+    def buckets_for(self, message, key=None):
+        if key is None:
+            key = message.connection_key
+        buckets = []
+        if self.connection_rate:
+            buckets.append(self.get_bucket(("connection", key),
+                                           self.connection_rate, self.connection_burst))
+        if self.domain_rates:
+            for domain in recipient_domains(message.email):
+                rate = self.domain_rates.get(domain, self.domain_rates.get("*"))
+                if rate:
+                    # domains without a rate of their own each get a bucket
+                    buckets.append(self.get_bucket(("domain", domain), rate))
+        return buckets
+
+    def start(self, message, key=None):
+        """
+        Wait until message may be sent over the connection for key (by
+        default its own, message.connection_key). Returns a value to pass to
+        finish() once it has been.
+        """
+
+        if key is None:
+            key = message.connection_key
+        now = time.time()
+        delay = max([bucket.reserve(now) for bucket in self.buckets_for(message, key)] or [0])
+        if delay > 0:
+            time.sleep(delay)
+        # only take a slot once ready to send, so that waiting on a rate
+        # limit does not hold back sends that are not subject to it
+        limit = None
+        if self.adaptive:
+            limit = self.get_limit(key)
+            limit.acquire()
+        return limit, time.time()
+
+    def finish(self, started, err=None):
+        """
+        Record the outcome of a send begun with start(): err is the exception
+        it failed with, if any.
+        """
+
+        limit, start_time = started
+        if limit is not None:
+            overloaded = (time.time() - start_time > TARGET_LATENCY or
+                          (err is not None and is_overload(err)))
+            limit.release(overloaded)